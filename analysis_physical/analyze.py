@@ -1,4 +1,5 @@
 #%%
+import os
 import numpy as np
 import json
 from raster import readTif, tifGetBbox, saveToTif, makeTransform
@@ -53,6 +54,19 @@ def scaleBandData(rawData, bandNr, metaData):
     return rawData * mult + add
 
 
+def isLevel2(metaData):
+    # collection-2 level-2 (L2SP) scenes ship a ready-made surface-temperature band, ST_B10
+    return "LEVEL2_SURFACE_TEMPERATURE_PARAMETERS" in metaData["LANDSAT_METADATA_FILE"]
+
+
+def scaleSurfaceTemperature(rawData, metaData):
+    # to kelvin; for collection 2 that's rawData * 0.00341802 + 149.0
+    params = metaData["LANDSAT_METADATA_FILE"]["LEVEL2_SURFACE_TEMPERATURE_PARAMETERS"]
+    mult = float(params["TEMPERATURE_MULT_BAND_ST_B10"])
+    add = float(params["TEMPERATURE_ADD_BAND_ST_B10"])
+    return rawData * mult + add
+
+
 def radiance2BrightnessTemperature(toaSpectralRadiance, metaData):
     # Brightness Temperature:
     # If the TOA were a black-body, it would have to have this temperature
@@ -369,6 +383,53 @@ def lstFromFile_OSM(pathToFile, fileNameBase, aoi, osmBuildings, osmVegetation):
 
 
 
+def lstFromFile_L2(pathToFile, fileNameBase, aoi):
+    """
+        Level-2 scenes: USGS has already done the radiance-, emissivity- and atmosphere-steps,
+        so this only reads ST_B10 and QA_PIXEL and rescales.
+    """
+
+    base = f"{pathToFile}/{fileNameBase}"
+    # `noDataValue` must not be np.nan, because then `==` doesn't work as expected
+    noDataValue = -9999
+
+    metaData = readMetaData(base + "MTL.json")
+
+    qaPixelFh               = readTif(base + "QA_PIXEL.TIF")
+    surfaceTemperatureFh    = readTif(base + "ST_B10.TIF")
+    assert(qaPixelFh.res == surfaceTemperatureFh.res)
+
+    qaPixelAOI              = tifGetBbox(qaPixelFh, aoi)[0]
+    # as float, so that `noDataValue` fits next to the uint16 raw values
+    surfaceTemperatureAOI   = tifGetBbox(surfaceTemperatureFh, aoi)[0].astype(np.float64)
+
+    # 0 is ST_B10's fill-value
+    surfaceTemperatureNoClouds = extractClouds(surfaceTemperatureAOI, qaPixelAOI, noDataValue)
+    noDataMask = (surfaceTemperatureNoClouds == noDataValue) | (surfaceTemperatureAOI == 0)
+
+    landSurfaceTemperature = scaleSurfaceTemperature(surfaceTemperatureNoClouds, metaData)
+    landSurfaceTemperature = np.where(noDataMask, np.nan, landSurfaceTemperature)
+
+    # adding projection metadata
+    imgH, imgW = landSurfaceTemperature.shape
+    transform = makeTransform(imgH, imgW, aoi)
+    saveToTif(f"{pathToFile}/lst.tif", landSurfaceTemperature, CRS.from_epsg(4326), transform, noDataValue)
+    lstTif = readTif(f"{pathToFile}/lst.tif")
+
+    return landSurfaceTemperature, lstTif
+
+
+def lstFromFile(pathToFile, fileNameBase, aoi, osmBuildings, osmVegetation):
+    """
+        Level-2 fast path where the scene has a surface-temperature band, `lstFromFile_OSM` on level-1 data otherwise
+    """
+    base = f"{pathToFile}/{fileNameBase}"
+    if os.path.exists(base + "ST_B10.TIF") and isLevel2(readMetaData(base + "MTL.json")):
+        return lstFromFile_L2(pathToFile, fileNameBase, aoi)
+    return lstFromFile_OSM(pathToFile, fileNameBase, aoi, osmBuildings, osmVegetation)
+
+
+
 # execute
 
 if __name__ == "__main__":
@@ -382,7 +443,7 @@ if __name__ == "__main__":
     osmBuildings = json.load(fh)
     osmVegetation = { "type": "FeatureCollection", "features": [] }
 
-    lst, lstFile = lstFromFile_OSM(pathToFile, fileNameBase, aoi, osmBuildings, osmVegetation)
+    lst, lstFile = lstFromFile(pathToFile, fileNameBase, aoi, osmBuildings, osmVegetation)
 
     fig, axes = plt.subplots(1, 2)
     axes[0].imshow(lst)
@@ -0,0 +1,134 @@
+#%%
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio as rio
+import rasterio.shutil as rios
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from raster import readTif
+
+
+"""
+    Per-pixel temporal composites (clear-observation count, mean, median, percentiles) over many `lst_{dateTime}.tif`.
+    The aoi is walked block by block; each worker only ever holds one block of every scene,
+    so memory scales with block-size * nr of scenes, not with aoi-size * nr of scenes.
+    Medians and percentiles are exact: every block sees its pixels' complete stack.
+"""
+
+
+#%% scene-selection
+
+def lstPaths(resultsDir, startDate=None, endDate=None):
+    """
+        All `lst_{dateTime}.tif` in `resultsDir` acquired in [startDate, endDate] (yyyy-mm-dd, both optional), in order of time
+    """
+    paths = []
+    for fileName in sorted(os.listdir(resultsDir)):
+        if not (fileName.startswith("lst_") and fileName.endswith(".tif")):
+            continue
+        date = fileName[len("lst_"):len("lst_") + len("yyyy-mm-dd")]
+        if (startDate is None or date >= startDate) and (endDate is None or date <= endDate):
+            paths.append(os.path.join(resultsDir, fileName))
+    return paths
+
+
+#%% worker
+
+_worker = {}
+
+def _openAligned(path, reference):
+    # scenes on another grid than the reference are warped onto it, on the fly and per block
+    fh = readTif(path)
+    if fh.crs == reference["crs"] and fh.transform == reference["transform"] and fh.shape == (reference["height"], reference["width"]):
+        return fh
+    return WarpedVRT(fh, crs=reference["crs"], transform=reference["transform"], width=reference["width"],
+                     height=reference["height"], resampling=Resampling.nearest, src_nodata=fh.nodata, nodata=np.nan)
+
+
+def _initWorker(paths, reference):
+    _worker["fhs"] = [_openAligned(path, reference) for path in paths]
+
+
+def _compositeWindow(window, percentiles):
+    stack = np.empty((len(_worker["fhs"]), int(window.height), int(window.width)), dtype=np.float32)
+    for i, fh in enumerate(_worker["fhs"]):
+        data = fh.read(1, window=window, out_dtype=np.float32)
+        if fh.nodata is not None and not np.isnan(fh.nodata):
+            data[data == fh.nodata] = np.nan
+        stack[i] = data
+
+    count = np.sum(~np.isnan(stack), axis=0).astype(np.float32)
+    with warnings.catch_warnings():
+        # pixels without any clear observation are nan in all statistics
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean = np.nanmean(stack, axis=0)
+        quantiles = np.nanpercentile(stack, [50] + list(percentiles), axis=0)
+
+    return window, np.concatenate([count[np.newaxis], mean[np.newaxis], quantiles]).astype(np.float32)
+
+
+#%% composite
+
+def _blockWindows(height, width, blockSize):
+    for r in range(0, height, blockSize):
+        for c in range(0, width, blockSize):
+            yield rio.windows.Window(c, r, min(blockSize, width - c), min(blockSize, height - r))
+
+
+def compositeScenes(paths, outPath, percentiles=(10, 90), blockSize=256, nrWorkers=None):
+    """
+        Writes a multi-band COG to `outPath`, on the grid of `paths[0]`:
+            band 1: nr of clear observations
+            band 2: mean
+            band 3: median
+            band 4...: the requested `percentiles`
+        Band-descriptions carry these names; the scenes composited are listed in the tag `scenes`.
+        Pixels that are nan or nodata in a scene count as not observed.
+    """
+    with readTif(paths[0]) as fh:
+        reference = {"crs": fh.crs, "transform": fh.transform, "height": fh.height, "width": fh.width}
+
+    bandNames = ["count", "mean", "median"] + [f"p{p:g}" for p in percentiles]
+    options = {
+        'driver': 'GTiff',
+        'compress': 'lzw',
+        'tiled': True,
+        'blockxsize': blockSize,
+        'blockysize': blockSize,
+        'width': reference["width"],
+        'height': reference["height"],
+        'count': len(bandNames),
+        'dtype': 'float32',
+        'crs': reference["crs"],
+        'transform': reference["transform"],
+        'nodata': np.nan,
+    }
+    windows = list(_blockWindows(reference["height"], reference["width"], blockSize))
+
+    tempPath = outPath + "_temp.tiff"
+    with rio.open(tempPath, 'w', **options) as dst, \
+         ProcessPoolExecutor(max_workers=nrWorkers, initializer=_initWorker, initargs=(paths, reference)) as executor:
+
+        for band, name in enumerate(bandNames):
+            dst.set_band_description(band + 1, name)
+        dst.update_tags(scenes=",".join(os.path.basename(p) for p in paths))
+
+        futures = [executor.submit(_compositeWindow, window, percentiles) for window in windows]
+        for i, future in enumerate(as_completed(futures)):
+            window, composite = future.result()
+            dst.write(composite, window=window)
+            print(f"... {100 * (i + 1) / len(windows):.1f}%")
+
+    # same as `saveToCOG(..., mode="copy")`
+    rios.copy(tempPath, outPath, driver="COG")
+    rios.delete(tempPath)
+    return outPath
+
+
+
+#%%
+if __name__ == "__main__":
+    summer = lstPaths("./results", "2022-06-01", "2022-08-31")
+    compositeScenes(summer, "./results/composite_summer2022.tif", percentiles=(10, 25, 75, 90))
@@ -1,5 +1,6 @@
 #%%
 import os
+import sys
 import json
 import numpy as np
 import fiona
@@ -8,7 +9,9 @@ import matplotlib.pyplot as plt
 
 from raster import readTif, tifGetPixelSizeDegrees, tifGetBbox, saveToCOG, makeTransform, tifGetPixelRowsCols
 from vectorAndRaster import rasterizePercentage
-from analyze import extractClouds, scaleBandData, radiance2BrightnessTemperature, bt2lstSingleWindow
+from landsatTar import sceneIdFromTar, sceneFromTar, readTarMember
+from sceneCatalog import SceneCatalog, aoiClearFraction
+from analyze import extractClouds, scaleBandData, radiance2BrightnessTemperature, bt2lstSingleWindow, isLevel2, scaleSurfaceTemperature
 
 
 #%%
@@ -16,6 +19,8 @@ np.seterr(all="ignore")
 
 
 def readJson(path):
+    if path.startswith("/vsitar/"):
+        return json.loads(readTarMember(path))
     fh = open(path)
     data = json.load(fh)
     return data
@@ -49,6 +54,16 @@ def estimateLst(b10, qa, meta, buildingFraction, roadsFraction):
     lst = np.where(noDataMask, np.nan, lst)
     return lst
 
+def estimateLstL2(st, qa, meta):
+    # level-2 fast path: ST_B10 already is the surface temperature; 0 is its fill-value
+    noDataValue = -9999
+    st = st.astype(np.float64)  # so that `noDataValue` fits next to the uint16 raw values
+    stNoClouds = extractClouds(st, qa, noDataValue)
+    noDataMask = (stNoClouds == noDataValue) | (st == 0)
+    lst = scaleSurfaceTemperature(stNoClouds, meta) - 273
+    lst = np.where(noDataMask, np.nan, lst)
+    return lst
+
 def saveRaster(path, data, bbox, extraProps):
     rows, cols = data.shape
     transform = makeTransform(rows, cols, bbox)
@@ -61,16 +76,69 @@ def getDateTime(meta):
     time = meta["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]["SCENE_CENTER_TIME"]
     return f"{date} {time}"
 
-def getLs8Scenes(rootPath, fileDict):
+def getLs8Scenes(rootPath, fileDict, skip=None):
+    """
+        skip: called with every scene-id (the directory- or tar-name); scenes it returns True for
+              are not looked into at all, e.g. `catalog.hasScene` for the scenes ingested before
+    """
     scenes = []
-    for dir in os.listdir(rootPath):
-        if dir[-3:] != "tar":
+    entries = {entry.name: entry.is_dir() for entry in os.scandir(rootPath)}
+    for dir, isDir in entries.items():
+        if not isDir and not dir.endswith(".tar"):
+            # `.part`-files, the download-manifest, the catalog
+            continue
+        sceneId = dir if isDir else sceneIdFromTar(dir)
+        if skip is not None and skip(sceneId):
+            continue
+        if isDir:
             scene = {}
             for key, ending in fileDict.items():
-                scene[key] = f"{rootPath}/{dir}/{dir}_{ending}"
+                # level-1 and level-2 scenes have different bands; only keep those that exist
+                if os.path.exists(f"{rootPath}/{dir}/{dir}_{ending}"):
+                    scene[key] = f"{rootPath}/{dir}/{dir}_{ending}"
             scenes.append(scene)
+        elif not entries.get(sceneId, False):
+            # not extracted (see `landsatTar.extractScenes`): read straight from the archive
+            scenes.append(sceneFromTar(f"{rootPath}/{dir}", fileDict))
     return scenes
 
+def preflight(scenes, bbox, minClearFraction, maxSceneCloudCover, qaDecimation):
+    """
+        Cheap checks before any full read:
+            1. the MTL's scene-wide CLOUD_COVER, as a first cut (the same cut `SceneCatalog` makes at ingest,
+               so these scenes have not been QA-read or clipped either)
+            2. the aoi's clear-sky fraction, from the catalog or else from a decimated QA_PIXEL-read
+        returns: scenes to process, report-entry per scene with the decision and why
+    """
+    toProcess = []
+    report = []
+    for scene in scenes:
+        meta = readJson(scene["meta"])
+        cloudCover = float(meta["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]["CLOUD_COVER"])
+        entry = {"meta": scene["meta"], "dateTime": getDateTime(meta), "cloudCover": cloudCover, "clearFraction": None}
+
+        if cloudCover > maxSceneCloudCover:
+            entry["decision"] = "skip"
+            entry["reason"] = f"scene cloud-cover {cloudCover}% > {maxSceneCloudCover}%"
+        else:
+            clearFraction = scene["clearFraction"] if "clearFraction" in scene else aoiClearFraction(scene["qa"], bbox, qaDecimation)
+            entry["clearFraction"] = clearFraction
+            if clearFraction < minClearFraction:
+                entry["decision"] = "skip"
+                entry["reason"] = f"aoi clear-sky fraction {clearFraction:.2f} < {minClearFraction}"
+            else:
+                entry["decision"] = "process"
+                entry["reason"] = None
+                toProcess.append(scene)
+
+        print(f"{entry['dateTime']}: {entry['decision']} {entry['reason'] or ''}")
+        report.append(entry)
+    return toProcess, report
+
+def saveRunReport(path, runReport):
+    with open(path, "w") as fh:
+        json.dump(runReport, fh, indent=4)
+
 def getSceneShape(path, bbox):
     tifFile = readTif(path)
     data = tifGetBbox(tifFile, bbox)
@@ -82,13 +150,49 @@ def getSceneShape(path, bbox):
 pathToLs8Data          = "./ls8"
 pathToOsmDataBuildings = "./osm/buildings.geo.json"
 pathToOsmDataRoads     = "./osm/roads.geo.json"
-scenes                 = getLs8Scenes(pathToLs8Data, {"b10": "B10.TIF", "qa": "QA_PIXEL.TIF", "meta": "MTL.json"})
 bbox                   = { "lonMin": 11.214, "latMin": 48.064, "lonMax": 11.338, "latMax": 48.117 }
+minClearFraction       = 0.5      # of the aoi; scenes below are skipped
+maxSceneCloudCover     = 95       # [%], MTL CLOUD_COVER; scenes above are skipped without opening QA_PIXEL
+qaDecimation           = 8        # QA_PIXEL is read at 1/8th resolution for the clear-sky fraction
+runReportPath          = "./results/runReport.json"
+
+
+#%% scene-selection: only scenes that cover the aoi ever get opened
+# also clips every scene to the aoi once; later runs read those small clips instead of the full scenes.
+# Scenes already in the catalog are recognized by name, without opening their directory or archive;
+# new ones above `maxSceneCloudCover` are catalogued from their MTL alone, without QA-read or clip.
+catalog = SceneCatalog(f"{pathToLs8Data}/catalog.sqlite", clipDir="./ls8_clipped", qaDecimation=qaDecimation,
+                       maxSceneCloudCover=maxSceneCloudCover)
+newScenes = getLs8Scenes(pathToLs8Data, {"b10": "B10.TIF", "st": "ST_B10.TIF", "qa": "QA_PIXEL.TIF", "meta": "MTL.json"}, skip=catalog.hasScene)
+for scene in newScenes:
+    catalog.ingestScene(scene)
+print(f"Ingested {len(newScenes)} new scenes")
+catalog.registerAoi("aoi", bbox)
+candidateScenes        = catalog.query("aoi")
+
+
+#%% pre-flight: skip scenes that are clouded over the aoi before paying for reads, lst and the building-loop
+scenes, preflightReport = preflight(candidateScenes, bbox, minClearFraction, maxSceneCloudCover, qaDecimation)
+runReport = {
+    "bbox": bbox,
+    "minClearFraction": minClearFraction,
+    "maxSceneCloudCover": maxSceneCloudCover,
+    "qaDecimation": qaDecimation,
+    "scenes": preflightReport,
+}
+os.makedirs("./results", exist_ok=True)
+saveRunReport(runReportPath, runReport)
+print(f"{len(scenes)} of {len(candidateScenes)} scenes pass the pre-flight")
+if len(scenes) == 0:
+    # e.g. an all-cloudy archive; the run-report above says why every scene was skipped
+    print(f"Nothing to process; see {runReportPath}")
+    sys.exit(0)
 
 
 #%%
-distance      = 2 * getMaxPixelSize(scenes[0]["b10"])
-sceneShape    = getSceneShape(scenes[0]["b10"], bbox)
+# QA_PIXEL shares the thermal bands' grid, and exists for level-1 and level-2 scenes alike
+distance      = 2 * getMaxPixelSize(scenes[0]["qa"])
+sceneShape    = getSceneShape(scenes[0]["qa"], bbox)
 roadSize      = 0.01 * distance
 noDataValue   = -9999
 
@@ -123,10 +227,17 @@ for scene in scenes:
 
     meta      = readJson(scene["meta"])
     dateTime  = getDateTime(meta)
-    b10       = getPixelData(scene["b10"], bbox)[0]
     qa        = getPixelData(scene["qa"], bbox)[0]
-    lst       = estimateLst(b10, qa, meta, housesFraction, roadsFraction)
+    if "st" in scene and isLevel2(meta):
+        st    = getPixelData(scene["st"], bbox)[0]
+        lst   = estimateLstL2(st, qa, meta)
+    else:
+        b10   = getPixelData(scene["b10"], bbox)[0]
+        lst   = estimateLst(b10, qa, meta, housesFraction, roadsFraction)
     lstTif    = saveRaster(f"./results/lst_{dateTime}.tif", lst, bbox, {"dateTime": dateTime})    
+    reportEntry = next(e for e in preflightReport if e["meta"] == scene["meta"])
+    reportEntry["lst"] = f"./results/lst_{dateTime}.tif"
+    saveRunReport(runReportPath, runReport)
 
     buildingNr = 0
     for building in buildingData:
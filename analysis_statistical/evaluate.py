@@ -0,0 +1,119 @@
+#%% imports
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn import tree
+from sklearn import ensemble
+from sklearn.model_selection import KFold
+from analysis_statistical.maxLlh import MaxLlh
+
+
+"""
+    k-fold cross-validation of the statistical models, with timing.
+    Next to the accuracy-metrics every model gets fit- and predict-wall-time and predict-throughput,
+    so models can be picked on inference-cost for full-scene runs as well.
+"""
+
+
+#%% models
+
+# name -> (class, constructor-kwargs, whether targets are rounded to BER-classes before fitting)
+defaultModels = {
+    "maxLlh":       (MaxLlh,                          {},                                        True),
+    "decisionTree": (tree.DecisionTreeRegressor,      {"max_depth": 4, "min_samples_leaf": 3},   False),
+    "randomForest": (ensemble.RandomForestRegressor,  {},                                        False),
+}
+
+
+def metrics(Y, Ypred):
+    err = Y - Ypred
+    return {
+        "sse":           float(np.sum(err * err)),
+        "rmse":          float(np.sqrt(np.mean(err * err))),
+        "mae":           float(np.mean(np.abs(err))),
+        "r2":            float(1 - np.sum(err * err) / np.sum((Y - np.mean(Y)) ** 2)),
+        "classAccuracy": float(np.mean(np.round(Y) == np.round(Ypred))),
+    }
+
+
+#%% worker
+
+_data = {}
+
+def _initWorker(X, Y):
+    _data["X"] = X
+    _data["Y"] = Y
+
+
+def _evaluateFold(modelName, modelSpec, trainIdx, testIdx):
+    modelClass, kwargs, roundTargets = modelSpec
+    X, Y = _data["X"], _data["Y"]
+    Xtrain, Ytrain = X[trainIdx], Y[trainIdx]
+    Xtest, Ytest = X[testIdx], Y[testIdx]
+
+    model = modelClass(**kwargs)
+    start = time.perf_counter()
+    model.fit(Xtrain, np.round(Ytrain) if roundTargets else Ytrain)
+    fitSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Ypred = model.predict(Xtest)
+    predictSeconds = time.perf_counter() - start
+
+    result = metrics(Ytest, Ypred)
+    result["fitSeconds"] = fitSeconds
+    result["predictSeconds"] = predictSeconds
+    result["predictThroughput"] = len(testIdx) / predictSeconds if predictSeconds > 0 else float("inf")
+    return modelName, result
+
+
+#%% harness
+
+def evaluateModels(X, Y, models=defaultModels, nrFolds=5, seed=0, nrWorkers=None, reportPath=None):
+    """
+        Runs `nrFolds`-fold cross-validation for every model; all (model, fold)-pairs are fitted in parallel.
+        Timings are measured inside the workers, so with more pairs than cores they include some contention.
+
+        returns (and writes to `reportPath` as json, if given):
+            model-name -> {"folds": [per-fold metrics and timings], "mean": {...}, "std": {...}}
+    """
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    folds = list(KFold(n_splits=nrFolds, shuffle=True, random_state=seed).split(X))
+
+    with ProcessPoolExecutor(max_workers=nrWorkers, initializer=_initWorker, initargs=(X, Y)) as executor:
+        futures = [
+            executor.submit(_evaluateFold, name, spec, trainIdx, testIdx)
+            for name, spec in models.items()
+            for trainIdx, testIdx in folds
+        ]
+        results = [future.result() for future in futures]
+
+    report = {}
+    for name in models:
+        foldResults = [result for modelName, result in results if modelName == name]
+        keys = foldResults[0].keys()
+        report[name] = {
+            "folds": foldResults,
+            "mean": {key: float(np.mean([r[key] for r in foldResults])) for key in keys},
+            "std":  {key: float(np.std([r[key] for r in foldResults])) for key in keys},
+        }
+
+    if reportPath is not None:
+        with open(reportPath, "w") as fh:
+            json.dump({"nrSamples": len(Y), "nrFolds": nrFolds, "seed": seed, "models": report}, fh, indent=4)
+
+    return report
+
+
+
+#%%
+if __name__ == "__main__":
+    bandData = np.load("bandData.npy")
+    berClasses = np.load("berClasses.npy")
+    report = evaluateModels(bandData, berClasses, reportPath="evaluation.json")
+    for name, result in report.items():
+        mean = result["mean"]
+        print(f"{name:>14}: rmse {mean['rmse']:.3f}, r2 {mean['r2']:.3f}, class-accuracy {mean['classAccuracy']:.3f}, "
+              f"fit {mean['fitSeconds']:.3f}s, predict {mean['predictThroughput']:.0f} samples/s")
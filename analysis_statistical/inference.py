@@ -0,0 +1,131 @@
+#%% imports
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio as rio
+import rasterio.shutil as rios
+from dataReaders.reader import Ls8, BANDS, CLEAR_SKY, DEFAULT_SCENE
+
+
+"""
+    Applies a fitted model (MaxLlh, DecisionTreeRegressor, RandomForestRegressor, ...)
+    to every cloud-free pixel of a scene.
+    The scene is cut into block-aligned windows that are classified in a process-pool;
+    each worker only ever holds one window of the eleven bands.
+"""
+
+
+#%% confidence per model-type
+
+def predictWithConfidence(model, X):
+    """
+        returns: predictions, confidence in [0, 1] (nan where the model has no notion of confidence)
+            - MaxLlh:            posterior probability of the predicted class
+            - forests:           fraction of trees that agree with the (rounded) ensemble prediction
+            - everything else:   nan
+    """
+    if hasattr(model, "predictWithConfidence"):
+        return model.predictWithConfidence(X)
+
+    if hasattr(model, "estimators_"):
+        perTree = np.stack([tree.predict(X) for tree in model.estimators_], axis=0)
+        predictions = np.mean(perTree, axis=0)
+        confidence = np.mean(np.round(perTree) == np.round(predictions), axis=0)
+        return predictions, confidence
+
+    predictions = model.predict(X)
+    return predictions, np.full(len(predictions), np.nan)
+
+
+#%% worker
+
+_worker = {}
+
+def _initWorker(model, scenePath, bands):
+    _worker["model"] = model
+    _worker["ls8"] = Ls8(bands, scenePath)
+
+
+def _classifyWindow(window, noDataValue):
+    ls8 = _worker["ls8"]
+    clearSky = ls8.getQa(window) == CLEAR_SKY
+
+    classes = np.full(clearSky.shape, noDataValue, dtype=np.float32)
+    confidence = np.full(clearSky.shape, np.nan, dtype=np.float32)
+    if np.any(clearSky):
+        X = ls8.getWindow(window)[:, clearSky].transpose()
+        predictions, conf = predictWithConfidence(_worker["model"], X)
+        classes[clearSky] = predictions
+        confidence[clearSky] = conf
+
+    return window, classes, confidence
+
+
+#%% scene
+
+def _sceneWindows(fh, blockSize):
+    # multiples of the file's own blocks, so that no block is read by two workers
+    blockH, blockW = fh.block_shapes[0]
+    winH = max(blockSize // blockH, 1) * blockH
+    winW = max(blockSize // blockW, 1) * blockW
+    for r in range(0, fh.height, winH):
+        for c in range(0, fh.width, winW):
+            yield rio.windows.Window(c, r, min(winW, fh.width - c), min(winH, fh.height - r))
+
+
+def classifyScene(model, outPathBase, scenePath=DEFAULT_SCENE, bands=BANDS, blockSize=1024, nrWorkers=None, noDataValue=-9999):
+    """
+        Writes `{outPathBase}_class.tif` (predicted BER class, `noDataValue` where clouded)
+        and `{outPathBase}_confidence.tif` (see `predictWithConfidence`, nan where clouded) as COGs.
+        `model` must be picklable; it is sent once to each worker.
+    """
+    qa = rio.open(scenePath + "QA_PIXEL.TIF")
+    windows = list(_sceneWindows(qa, blockSize))
+    options = {
+        'driver': 'GTiff',
+        'compress': 'lzw',
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'width': qa.width,
+        'height': qa.height,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': qa.crs,
+        'transform': qa.transform,
+    }
+    qa.close()
+
+    classPath = f"{outPathBase}_class.tif"
+    confidencePath = f"{outPathBase}_confidence.tif"
+    with rio.open(classPath + "_temp.tiff", 'w', nodata=noDataValue, **options) as classDst, \
+         rio.open(confidencePath + "_temp.tiff", 'w', nodata=np.nan, **options) as confidenceDst, \
+         ProcessPoolExecutor(max_workers=nrWorkers, initializer=_initWorker, initargs=(model, scenePath, bands)) as executor:
+
+        futures = [executor.submit(_classifyWindow, window, noDataValue) for window in windows]
+        for i, future in enumerate(as_completed(futures)):
+            window, classes, confidence = future.result()
+            classDst.write(classes, 1, window=window)
+            confidenceDst.write(confidence, 1, window=window)
+            print(f"... {100 * (i + 1) / len(windows):.1f}%")
+
+    # same as `saveToCOG(..., mode="copy")`
+    for path in [classPath, confidencePath]:
+        rios.copy(path + "_temp.tiff", path, driver="COG")
+        rios.delete(path + "_temp.tiff")
+
+    return classPath, confidencePath
+
+
+
+#%%
+if __name__ == "__main__":
+    from analysis_statistical.maxLlh import MaxLlh
+
+    bandData = np.load("bandData.npy")
+    berClasses = np.load("berClasses.npy")
+    mllhClf = MaxLlh()
+    mllhClf.fit(bandData, np.round(berClasses))
+
+    os.makedirs("results", exist_ok=True)
+    classifyScene(mllhClf, "results/maxLlh")
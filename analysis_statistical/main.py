@@ -2,7 +2,8 @@
 from sklearn import tree
 from sklearn import ensemble
 from analysis_statistical.maxLlh import MaxLlh
-from dataReaders.reader import loadData
+from dataReaders.reader import sampleToStore
+from dataReaders.datasetStore import DatasetStore
 import numpy as np
 
 
@@ -14,9 +15,10 @@ nrTestingSamples = 100
 #%% data
 bandData = np.load("bandData.npy")
 berClasses = np.load("berClasses.npy")
-# bandData, berClasses = loadData(nrTrainingSamples + nrTestingSamples)
-# np.save("bandData.npy", bandData)
-# np.save("berClasses.npy", berClasses)
+# store = DatasetStore("data/samples")          # re-running resumes an interrupted sampling-run
+# sampleToStore(store, nrTrainingSamples + nrTestingSamples, seed=42)
+# samples = store.load()                         # memory-mapped
+# bandData, berClasses = samples["X"], samples["Y"]
 
 #%%
 bandDataTrain = bandData[:nrTrainingSamples]
@@ -49,8 +51,13 @@ tree.plot_tree(treeClf, ax=ax, fontsize=8, label='root', filled=True, impurity=F
 #%% Random forrest classifier
 rdfrClf = ensemble.RandomForestRegressor()
 rdfrClf.fit(bandDataTrain, berClassesTrain)
-rdfrScore = treeClf.score(bandDataTest, berClassesTest)
+rdfrScore = rdfrClf.score(bandDataTest, berClassesTest)
 print(rdfrScore)
 
 
+#%% Cross-validated comparison, including fit/predict timing
+# from analysis_statistical.evaluate import evaluateModels
+# report = evaluateModels(bandData, berClasses, nrFolds=5, reportPath="evaluation.json")
+
+
 # %%
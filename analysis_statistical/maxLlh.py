@@ -1,30 +1,121 @@
-import scipy.stats._multivariate as mult
 import numpy as np
 
 
 class MaxLlh:
-    
+    """
+        Maximum-likelihood classifier: one multivariate normal per class.
+        Classes are scored in log-likelihood form (raw pdfs of 11 bands underflow to 0),
+        all classes at once and in fixed-size chunks, so that whole scenes can be predicted in bounded memory.
+    """
+
+    def __init__(self, chunkSize=16384, regularization=1e-6) -> None:
+        """
+            chunkSize:      nr of samples scored at once; memory is ~ chunkSize * classes * bands floats
+            regularization: added to the covariance-diagonals (relative to the mean band-variance),
+                            so that degenerate classes still have a Cholesky factor
+        """
+        self.chunkSize = chunkSize
+        self.regularization = regularization
+
+
     def fit(self, X, Y):
         """
         X: n * b numpy array
             n: nr of samples
             b: nr of bands
         """
-        
-        classData = {}
-        for x, y in zip(X, Y):
-            if y not in classData:
-                classData[y] = []
-            classData[y].append(x)
-        
-        stats = {}
-        for className, classData in classData.items():
-            mean = np.mean(classData, axis=0)
-            dm = X - mean
-            cov = dm.transpose() @ dm
-            stats[className] = {"mean": mean, "cov": cov}
+        self.reset()
+        self.partial_fit(X, Y)
+        self.finalize()
+
+
+    def reset(self):
+        # per-class sufficient statistics, in float64: counts, sums and sums of outer products
+        self.counts = {}
+        self.sums = {}
+        self.outerSums = {}
+
+
+    def partial_fit(self, X, Y):
+        """
+            Accumulates the sufficient statistics of one batch; call `finalize` once all batches are in.
+            Memory is O(classes * bands^2), independent of the nr of samples seen.
+        """
+        if not hasattr(self, "counts"):
+            self.reset()
+        X = np.asarray(X, dtype=np.float64)
+        classes, inverse = np.unique(np.asarray(Y), return_inverse=True)
+        for i, className in enumerate(classes):
+            classData = X[inverse.ravel() == i]
+            if className not in self.counts:
+                self.counts[className] = 0
+                self.sums[className] = np.zeros(X.shape[1])
+                self.outerSums[className] = np.zeros((X.shape[1], X.shape[1]))
+            self.counts[className] += len(classData)
+            self.sums[className] += np.sum(classData, axis=0)
+            self.outerSums[className] += classData.transpose() @ classData
+
 
-        self.stats = stats
+    def merge(self, other):
+        """
+            Adds the statistics accumulated by another MaxLlh (e.g. one per worker) to this one.
+        """
+        if not hasattr(self, "counts"):
+            self.reset()
+        for className in other.counts:
+            if className not in self.counts:
+                self.counts[className] = 0
+                self.sums[className] = np.zeros_like(other.sums[className])
+                self.outerSums[className] = np.zeros_like(other.outerSums[className])
+            self.counts[className] += other.counts[className]
+            self.sums[className] += other.sums[className]
+            self.outerSums[className] += other.outerSums[className]
+        return self
+
+
+    def finalize(self):
+        """
+            Turns the accumulated statistics into means and covariances.
+        """
+        classes = np.array(sorted(self.counts.keys()))
+        counts = np.array([self.counts[c] for c in classes], dtype=np.float64)
+        sums = np.stack([self.sums[c] for c in classes])
+        outerSums = np.stack([self.outerSums[c] for c in classes])
+
+        means = sums / counts[:, np.newaxis]
+        covs = outerSums / counts[:, np.newaxis, np.newaxis] - means[:, :, np.newaxis] * means[:, np.newaxis, :]
+
+        totalMean = np.sum(sums, axis=0) / np.sum(counts)
+        totalVar = np.diagonal(np.sum(outerSums, axis=0)) / np.sum(counts) - totalMean * totalMean
+        ridge = self.regularization * np.mean(totalVar) * np.eye(means.shape[1])
+
+        self._setStats(classes, means, covs + ridge)
+
+
+    def _setStats(self, classes, means, covs):
+        self.classes = classes
+        self.means = means
+        self.cholesky = np.linalg.cholesky(covs)
+        # scoring needs L^-1; (x - mean)^T cov^-1 (x - mean) = |L^-1 (x - mean)|^2
+        self.choleskyInv = np.linalg.inv(self.cholesky)
+        self.offsets = np.einsum("kcb,kb->kc", self.choleskyInv, self.means)
+        logDets = 2 * np.sum(np.log(np.diagonal(self.cholesky, axis1=1, axis2=2)), axis=1)
+        nrBands = means.shape[1]
+        self.logNormalizers = -0.5 * (logDets + nrBands * np.log(2 * np.pi))
+
+
+    def logLikelihoods(self, X):
+        """
+            X: n * b numpy array
+            returns: n * k array of log-likelihoods, k: nr of classes (in order of `self.classes`)
+        """
+        X = np.asarray(X, dtype=np.float64)
+        llhs = np.empty((X.shape[0], len(self.classes)))
+        for start in range(0, X.shape[0], self.chunkSize):
+            chunk = X[start:start + self.chunkSize]
+            z = chunk @ self.choleskyInv.transpose(0, 2, 1) - self.offsets[:, np.newaxis, :]   # k * n * b
+            llhs[start:start + self.chunkSize] = self.logNormalizers - 0.5 * np.einsum("knc,knc->nk", z, z)
+        return llhs
 
 
     def predict(self, X):
@@ -33,26 +124,30 @@ class MaxLlh:
                 n: nr of samples
                 b: nr of bands
         """
-        nrSamples, nrBands = X.shape
+        X = np.asarray(X)
+        predictions = np.empty(X.shape[0], dtype=self.classes.dtype)
+        for start in range(0, X.shape[0], self.chunkSize):
+            llhs = self.logLikelihoods(X[start:start + self.chunkSize])
+            predictions[start:start + self.chunkSize] = self.classes[np.argmax(llhs, axis=1)]
+        return predictions
 
-        llhsPerClass = {}
-        for className, classStats in self.stats.items():
-            dist = mult.multivariate_normal(classStats["mean"], classStats["cov"], allow_singular=True)
-            llhs = dist.pdf(X)
-            llhsPerClass[className] = llhs
-        
-        predictions = np.zeros((nrSamples,))
-        for i in range(nrSamples):
-            maxLlh = 0
-            maxLlhClass = "NONE"
-            for className, llhs in llhsPerClass.items():
-                llh = llhs[i]
-                if llh > maxLlh:
-                    maxLlh = llh
-                    maxLlhClass = className
-            predictions[i] = maxLlhClass
 
-        return predictions
+    def predictWithConfidence(self, X):
+        """
+            Like `predict`, but also returns the posterior probability of the predicted class
+            (equal class-priors), as a confidence in [0, 1].
+        """
+        X = np.asarray(X)
+        predictions = np.empty(X.shape[0], dtype=self.classes.dtype)
+        confidence = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], self.chunkSize):
+            llhs = self.logLikelihoods(X[start:start + self.chunkSize])
+            best = np.argmax(llhs, axis=1)
+            # softmax, shifted by the maximum for stability: p(best) = 1 / sum(exp(llh - llhMax))
+            llhMax = np.take_along_axis(llhs, best[:, np.newaxis], axis=1)
+            predictions[start:start + self.chunkSize] = self.classes[best]
+            confidence[start:start + self.chunkSize] = 1.0 / np.sum(np.exp(llhs - llhMax), axis=1)
+        return predictions, confidence
 
 
     def score(self, X, Y):
@@ -62,5 +157,3 @@ class MaxLlh:
         err2 = err * err
         sse = np.sum(err2)
         return sse
-
-
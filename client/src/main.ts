@@ -2,16 +2,18 @@ import './style.css';
 import 'ol/ol.css';
 import { Map, MapBrowserEvent, Overlay, View } from 'ol';
 import TileLayer from 'ol/layer/Tile';
-import WGLTileLayer from 'ol/layer/WebGLTile';
 import OSM from 'ol/source/OSM';
+import XYZ from 'ol/source/XYZ';
 import VectorLayer from 'ol/layer/Vector';
 import VectorSource from 'ol/source/Vector';
 import GeoJSON from 'ol/format/GeoJSON';
 import Style from 'ol/style/Style';
 import Fill from 'ol/style/Fill';
 import Feature, { FeatureLike } from 'ol/Feature';
-import { GeoTIFF } from 'ol/source';
-import vectorData from './buildings_temperature.geo.json';
+import { tile as tileStrategy } from 'ol/loadingstrategy';
+import { createXYZ } from 'ol/tilegrid';
+import { getCenter } from 'ol/extent';
+import { fromLonLat } from 'ol/proj';
 import { colorScale } from './graph';
 import { Datum, barchart } from './barchart';
 
@@ -26,6 +28,14 @@ import { Datum, barchart } from './barchart';
 
 
 
+/**********************************************
+ *   CONFIG
+ *********************************************/
+
+// Local tile server, see server/tileServer.py
+const tileServerUrl = 'http://localhost:8000';
+
+
 /**********************************************
  *   STATE
  *********************************************/
@@ -99,38 +109,33 @@ const baseLayer = new TileLayer({
   opacity: 0.7
 });
 
-const cogLayer = new WGLTileLayer({
-  source: new GeoTIFF({
-    sources: [{ url: `/public/lst_${state.currentTime}.tif` }]
-  }),
-  style: {
-    // https://openlayers.org/workshop/en/cog/ndvi.html
-    color: [
-      'interpolate',
-      ['linear'],
-      ['band', 1],
-      -0.05,  [0, 0, 0],
-      0.0,  [125, 125, 125],
-      0.05,  [256, 256, 256]
-    ]
-  },
+// Only the tiles in view are fetched; colour-ramp and no-data are applied server-side.
+const cogLayer = new TileLayer({
+  source: createLstSource(state.currentTime),
   opacity: 0.6,
   visible: false
 });
 
 
+// Building tiles come with full geometries and ids, so features spanning several tiles are only added once.
+const buildingTileGrid = createXYZ({ tileSize: 256 });
 const vectorLayer = new VectorLayer({
   source: new VectorSource({
-    features: new GeoJSON().readFeatures(vectorData)
+    format: new GeoJSON(),
+    url: (extent, resolution) => {
+      const [z, x, y] = buildingTileGrid.getTileCoordForCoordAndResolution(getCenter(extent), resolution);
+      return `${tileServerUrl}/buildings/${z}/${x}/${y}.geojson`;
+    },
+    strategy: tileStrategy(buildingTileGrid)
   }),
   style: createVectorStyle(state),
-  opacity: 0.8
+  opacity: 0.8,
+  minZoom: 13
 });
 
 const view = new View({
-  center: [11.3, 48.08],
-  zoom: 14,
-  projection: 'EPSG:4326'
+  center: fromLonLat([11.3, 48.08]),
+  zoom: 14
 });
 
 const popupOverlay = new Overlay({
@@ -242,9 +247,7 @@ function updateMap(state: State) {
     const style = createVectorStyle(state);
     vectorLayer.setStyle(style);
     cogLayer.setVisible(true);
-    cogLayer.setSource(new GeoTIFF({
-      sources: [{ url: `/public/lst_${state.currentTime}.tif` }]
-    }));
+    cogLayer.setSource(createLstSource(state.currentTime));
   }
 
 }
@@ -333,6 +336,12 @@ function updateTimeButtons(state: State) {
  *   HELPERS
  *********************************************/
 
+function createLstSource(time: string) {
+  return new XYZ({
+    url: `${tileServerUrl}/lst/${encodeURIComponent(time)}/{z}/{x}/{y}.png`
+  });
+}
+
 function createVectorStyle(state: State) {
   // state.mode, state.statistic, state.currentTime
   if (state.mode === "mean") {
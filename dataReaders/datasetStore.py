@@ -0,0 +1,128 @@
+import os
+import json
+import numpy as np
+import shapely
+
+
+class DatasetStore:
+    """
+        Append-only store of training samples on disk.
+
+        Every `append` writes one compressed chunk (`chunk_000000.npz`, ...) and then updates `manifest.json`,
+        both atomically, so a crash loses at most the batch in flight and never corrupts earlier ones.
+        The manifest also records the sampling-seed and -cursor, which is what lets `sampleToStore` resume a run.
+
+        Per sample the store keeps provenance next to X and Y:
+            - sceneId, row, col
+            - footprint:  the pixel's outline ring as a 5 * 2 coordinate array
+            - featureIds: ids of the BER-features hit (ragged: `featureIds` + `featureIdOffsets`)
+
+        `load` consolidates all chunks once into uncompressed .npy-files and memory-maps those for training.
+    """
+
+    columns = ["X", "Y", "rows", "cols", "footprints", "sceneIds", "featureIds", "featureIdOffsets"]
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifestPath = os.path.join(path, "manifest.json")
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as fh:
+                self.manifest = json.load(fh)
+        else:
+            self.manifest = {"chunks": [], "sampling": {}}
+
+    @property
+    def nrSamples(self):
+        return sum(chunk["nrSamples"] for chunk in self.manifest["chunks"])
+
+    @property
+    def nrChunks(self):
+        return len(self.manifest["chunks"])
+
+    def _writeAtomic(self, path, write):
+        tempPath = f"{path}.{os.getpid()}.tmp"
+        with open(tempPath, "wb") as fh:
+            write(fh)
+        os.replace(tempPath, path)
+
+    def _saveManifest(self):
+        self._writeAtomic(self.manifestPath, lambda fh: fh.write(json.dumps(self.manifest, indent=4).encode("utf-8")))
+
+    def append(self, samples, sceneId, seed=None, sampling=None):
+        """
+            samples:  as returned by `sampleBulk`
+            seed:     the rng-seed the batch was drawn with, kept as provenance
+            sampling: state needed to resume the sampling-run (see `sampleToStore`); replaces the previous state
+        """
+        featureIds = [np.asarray(f, dtype=str) for f in samples["featureIds"]]
+        featureIdOffsets = np.concatenate([[0], np.cumsum([len(f) for f in featureIds])]).astype(np.int64)
+        nrSamples = len(samples["Y"])
+
+        chunkFile = f"chunk_{self.nrChunks:06d}.npz"
+        self._writeAtomic(os.path.join(self.path, chunkFile), lambda fh: np.savez_compressed(
+            fh,
+            X=np.asarray(samples["X"]),
+            Y=np.asarray(samples["Y"], dtype=np.float64),
+            rows=np.asarray(samples["rows"], dtype=np.int64),
+            cols=np.asarray(samples["cols"], dtype=np.int64),
+            footprints=shapely.get_coordinates(samples["shapes"]).reshape(nrSamples, 5, 2),
+            featureIds=np.concatenate(featureIds) if nrSamples > 0 else np.zeros(0, dtype=str),
+            featureIdOffsets=featureIdOffsets,
+        ))
+
+        self.manifest["chunks"].append({"file": chunkFile, "nrSamples": nrSamples, "sceneId": sceneId, "seed": seed})
+        if sampling is not None:
+            self.manifest["sampling"] = sampling
+        self._saveManifest()
+
+    @staticmethod
+    def _emptyColumns():
+        # what `load` returns for a store without chunks; X has no band-axis length to go by
+        return {
+            "X": np.zeros((0, 0)),
+            "Y": np.zeros(0, dtype=np.float64),
+            "rows": np.zeros(0, dtype=np.int64),
+            "cols": np.zeros(0, dtype=np.int64),
+            "footprints": np.zeros((0, 5, 2)),
+            "featureIds": np.zeros(0, dtype=str),
+            "sceneIds": np.zeros(0, dtype=str),
+        }
+
+    def _consolidate(self, consolidatedDir):
+        chunks = [np.load(os.path.join(self.path, chunk["file"])) for chunk in self.manifest["chunks"]]
+        if len(chunks) == 0:
+            columns = self._emptyColumns()
+        else:
+            columns = {}
+            for name in ["X", "Y", "rows", "cols", "footprints", "featureIds"]:
+                columns[name] = np.concatenate([chunk[name] for chunk in chunks])
+            columns["sceneIds"] = np.concatenate([np.full(c["nrSamples"], c["sceneId"]) for c in self.manifest["chunks"]]).astype(str)
+
+        # shift every chunk's offsets by the nr of ids in the chunks before it
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for chunk in chunks:
+            offsets.append(chunk["featureIdOffsets"][1:] + offsets[-1][-1])
+        columns["featureIdOffsets"] = np.concatenate(offsets)
+
+        os.makedirs(consolidatedDir, exist_ok=True)
+        for name, data in columns.items():
+            self._writeAtomic(os.path.join(consolidatedDir, f"{name}.npy"), lambda fh: np.save(fh, data))
+        self._writeAtomic(os.path.join(consolidatedDir, "nrChunks.json"), lambda fh: fh.write(json.dumps(self.nrChunks).encode("utf-8")))
+
+    def load(self, columns=("X", "Y"), mmap=True):
+        """
+            returns: dict column-name -> array, memory-mapped (read-only) unless `mmap=False`.
+            A store without chunks yields empty columns (X as 0 * 0).
+            Chunks are consolidated on first load and again only once new chunks have been appended.
+        """
+        consolidatedDir = os.path.join(self.path, "consolidated")
+        nrChunksPath = os.path.join(consolidatedDir, "nrChunks.json")
+        upToDate = False
+        if os.path.exists(nrChunksPath):
+            with open(nrChunksPath) as fh:
+                upToDate = json.load(fh) == self.nrChunks
+        if not upToDate:
+            self._consolidate(consolidatedDir)
+
+        return {name: np.load(os.path.join(consolidatedDir, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in columns}
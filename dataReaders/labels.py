@@ -0,0 +1,74 @@
+import numpy as np
+import rasterio as rio
+from shapely.geometry import box
+import shapely
+from utils.raster import readTif, tifGetBboxWindow, tifGetPixelOutlines
+from dataReaders.reader import BerIndex, getClassesAndWeights, CLEAR_SKY
+
+
+def _tileWindows(window, tileSize):
+    for r in range(window.row_off, window.row_off + window.height, tileSize):
+        for c in range(window.col_off, window.col_off + window.width, tileSize):
+            h = min(tileSize, window.row_off + window.height - r)
+            w = min(tileSize, window.col_off + window.width - c)
+            yield rio.windows.Window(c, r, w, h)
+
+
+def createLabelRaster(scenePath, berPath, labelPath, weightPath, tileSize=512, noDataValue=-9999):
+    """
+        Overlays every pixel of the scene at `scenePath` (any band, e.g. QA_PIXEL) with the BER-layer in one pass
+        and writes the area-weighted mean BER (as in `getClass`) to `labelPath` and the summed weights to `weightPath`.
+        Both rasters share the scene's grid, so training-sets become array-slicing (see `trainingDataFromLabels`).
+
+        Only the part of the scene covered by the BER-layer is processed, tile by tile;
+        tiles without any BER-feature are skipped after a single index-query.
+    """
+    berIndex = BerIndex(berPath)
+    lonMin, latMin, lonMax, latMax = berIndex.bounds
+    berBbox = {"lonMin": lonMin, "latMin": latMin, "lonMax": lonMax, "latMax": latMax}
+
+    with readTif(scenePath) as fh:
+        options = {
+            'driver': 'GTiff',
+            'compress': 'lzw',
+            'tiled': True,
+            'blockxsize': 512,
+            'blockysize': 512,
+            'width': fh.width,
+            'height': fh.height,
+            'count': 1,
+            'dtype': 'float32',
+            'crs': fh.crs,
+            'transform': fh.transform,
+            'nodata': noDataValue
+        }
+        berWindow = tifGetBboxWindow(fh, berBbox)
+        windows = list(_tileWindows(berWindow, tileSize))
+
+        with rio.open(labelPath, 'w', **options) as labelDst, rio.open(weightPath, 'w', **options) as weightDst:
+            for i, window in enumerate(windows):
+                print(f"... tile {i + 1}/{len(windows)}")
+
+                outlines = tifGetPixelOutlines(fh, window, cache=False)
+                tileBox = box(*shapely.total_bounds(outlines))
+                if len(berIndex.tree.query(tileBox)) == 0:
+                    continue
+
+                estimate, weight, _ = getClassesAndWeights(berIndex, outlines.ravel(), withFeatureIds=False)
+                label = np.where(weight > 0, estimate, noDataValue).reshape(outlines.shape)
+                weight = np.where(weight > 0, weight, noDataValue).reshape(outlines.shape)
+                labelDst.write(label.astype(np.float32), 1, window=window)
+                weightDst.write(weight.astype(np.float32), 1, window=window)
+
+
+def trainingDataFromLabels(ls8, labelPath, weightPath, minWeight=0.0):
+    """
+        All clear-sky pixels of `ls8` that carry a label (and a weight > `minWeight`)
+        returns: X (nrPixels * nrBands), Y (labels), W (weights)
+    """
+    with readTif(labelPath) as labelFh, readTif(weightPath) as weightFh:
+        labels = labelFh.read(1)
+        weights = weightFh.read(1)
+        mask = (labels != labelFh.nodata) & (weights > minWeight) & (ls8.getQa() == CLEAR_SKY)
+    rows, cols = np.nonzero(mask)
+    return ls8.getPoints(rows, cols), labels[rows, cols], weights[rows, cols]
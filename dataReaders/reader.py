@@ -1,9 +1,19 @@
 import numpy as np
 import json
 import fiona
-from utils.raster import readTif, tifLonLatToPixel, tifGetPixelOutline
+from utils.raster import readTif, tifReadCached, tifLonLatToPixel, tifGetPixelOutline, tifGetPixelOutlinesAt, tifGetBboxWindow, TifBlockReader
+import rasterio as rio
 from shapely.geometry import shape, box
+import shapely
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+# QA_PIXEL value of clear-sky pixels, see `extractClouds` in analysis_physical/analyze.py
+CLEAR_SKY = 21824
+BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10", "B11"]
+BER_CLASSES = np.arange(1, 16)
+DEFAULT_SCENE = "data/ls8/LC09_L1TP_206023_20230113_20230314_02_T1_"
 
 
 def loadGeoJson(path: str):
@@ -11,108 +21,337 @@ def loadGeoJson(path: str):
     return fh
 
 
-def getClass(jsn, shp: shape):
-    
-    bboxBuffered = shp.bounds
-    featuresIntersectingWithBbox = [f for f in jsn.filter(bbox=bboxBuffered)]
-
-    featureIds = []
-    data = []
-    for feature in featuresIntersectingWithBbox:
-        featureIds.append(feature.id)
-        berCount = feature.properties["BER_COUNT"]
-
-        if berCount is None or berCount <= 0:
-            continue
-
-        berCoverage = feature.properties["ESTIMATED_BER_COVERAGE"]
-        berCountA1 = feature.properties["A1"]   if feature.properties["A1"] else 0
-        berCountA2 = feature.properties["A2"]   if feature.properties["A2"] else 0
-        berCountA3 = feature.properties["A3"]   if feature.properties["A3"] else 0
-        berCountB1 = feature.properties["B1"]   if feature.properties["B1"] else 0
-        berCountB2 = feature.properties["B2"]   if feature.properties["B2"] else 0
-        berCountB3 = feature.properties["B3"]   if feature.properties["B3"] else 0
-        berCountC1 = feature.properties["C1"]   if feature.properties["C1"] else 0
-        berCountC2 = feature.properties["C2"]   if feature.properties["C2"] else 0
-        berCountC3 = feature.properties["C3"]   if feature.properties["C3"] else 0
-        berCountD1 = feature.properties["D1"]   if feature.properties["D1"] else 0
-        berCountD2 = feature.properties["D2"]   if feature.properties["D2"] else 0
-        berCountE1 = feature.properties["E1"]   if feature.properties["E1"] else 0
-        berCountE2 = feature.properties["E2"]   if feature.properties["E2"] else 0
-        berCountF  = feature.properties["F"]    if feature.properties["F"]  else 0
-        berCountG  = feature.properties["G"]    if feature.properties["G"]  else 0
-
-        featureShape = shape(feature.geometry)
-        intersection = featureShape.intersection(shp)
-        overlapDegree = intersection.area / shp.area
-
-        meanBer = 15 * berCountA1 + 14 * berCountA2 + 13 * berCountA3 + 12 * berCountB1 + 11 * berCountB2 + 10 * berCountB3 + 9 * berCountC1 + 8 * berCountC2 + 7 * berCountC3 + 6 * berCountD1 + 5 * berCountD2 + 4 * berCountE1 + 3 * berCountE2 + 2 * berCountF + 1 * berCountG
-        meanBer /= berCount
-
-        data.append({
-            "weight": overlapDegree * berCoverage,
-            "meanBer": meanBer
-        })
-
-    if len(data) <= 0:
-        return -9999, featureIds
-
-    weightSum = 0
-    estimate = 0
-    for datum in data:
-        weight = datum["weight"]
-        meanBer = datum["meanBer"]
-        estimate += weight * meanBer
-        weightSum += weight
-    if weightSum <= 0:
-        return -9999, featureIds
-    estimate /= weightSum
+class BerIndex:
+    """
+        The BER-layer, loaded once: an STRtree over the feature geometries plus numpy columns of the properties
+        `getClass` / `getClasses` need, with the per-feature mean BER precomputed.
+    """
+
+    classColumns = ["A1", "A2", "A3", "B1", "B2", "B3", "C1", "C2", "C3", "D1", "D2", "E1", "E2", "F", "G"]
+    classValues  = np.arange(15, 0, -1)   # A1 -> 15, ..., G -> 1
+
+    def __init__(self, path) -> None:
+        with loadGeoJson(path) as fh:
+            self.bounds = fh.bounds
+            features = list(fh)
+
+        def column(name):
+            return np.array([f.properties[name] or 0 for f in features], dtype=np.float64)
+
+        self.ids             = np.array([f.id for f in features])
+        self.geometries      = np.array([shape(f.geometry) for f in features])
+        self.berCount        = column("BER_COUNT")
+        self.berCoverage     = column("ESTIMATED_BER_COVERAGE")
+        self.classCounts     = np.stack([column(c) for c in self.classColumns], axis=-1)
+        self.hasBer          = self.berCount > 0
+        self.meanBer         = np.where(self.hasBer, self.classCounts @ self.classValues / np.where(self.hasBer, self.berCount, 1), np.nan)
+        self.tree            = shapely.STRtree(self.geometries)
+
+
+def getClass(berIndex: BerIndex, shp: shape):
+    estimates, featureIds = getClasses(berIndex, [shp])
+    return estimates[0], featureIds[0]
 
+
+def getClasses(berIndex: BerIndex, shapes):
+    """
+        Area-weighted mean BER for many pixel-outlines at once.
+        Every feature whose bbox touches an outline counts as a hit (as with `fiona.filter(bbox=...)`);
+        hits with a BER_COUNT are weighted by overlapDegree * ESTIMATED_BER_COVERAGE.
+        returns: estimates (-9999 where no data), array of hit feature-ids per outline
+    """
+    estimate, _, featureIds = getClassesAndWeights(berIndex, shapes)
     return estimate, featureIds
 
 
+def getClassesAndWeights(berIndex: BerIndex, shapes, withFeatureIds=True):
+    """
+        Like `getClasses`, but also returns the summed weight per outline:
+        estimates, weights, featureIds (None if not `withFeatureIds`)
+    """
+    shapes = np.asarray(shapes)
+    shapeIdx, featureIdx = berIndex.tree.query(shapes)
+
+    featureIds = None
+    if withFeatureIds:
+        order = np.argsort(shapeIdx, kind="stable")
+        shapeIdx, featureIdx = shapeIdx[order], featureIdx[order]
+        featureIds = np.split(berIndex.ids[featureIdx], np.cumsum(np.bincount(shapeIdx, minlength=len(shapes)))[:-1])
+
+    withBer = berIndex.hasBer[featureIdx]
+    shapeIdx, featureIdx = shapeIdx[withBer], featureIdx[withBer]
+    overlapDegree = shapely.area(shapely.intersection(berIndex.geometries[featureIdx], shapes[shapeIdx])) / shapely.area(shapes[shapeIdx])
+    weight = overlapDegree * berIndex.berCoverage[featureIdx]
+
+    weightSum = np.bincount(shapeIdx, weights=weight, minlength=len(shapes))
+    estimate = np.bincount(shapeIdx, weights=weight * berIndex.meanBer[featureIdx], minlength=len(shapes))
+    estimate = np.where(weightSum > 0, estimate / np.where(weightSum > 0, weightSum, 1), -9999)
+
+    return estimate, weightSum, featureIds
+
+
+class _MappedBand:
+    """
+        Same interface as `TifBlockReader`, for bands memory-mapped through `tifReadCached`
+    """
+
+    def __init__(self, data) -> None:
+        self.data = data
+
+    def getPoints(self, rows, cols):
+        return self.data[rows, cols]
+
+    def getWindow(self, window):
+        return np.asarray(self.data[window.toslices()])
+
+
 class Ls8:
-    def __init__(self, bands) -> None:
-        path = "data/ls8/"
-        baseFileName = "LC09_L1TP_206023_20230113_20230314_02_T1_"
-        self.fhs = [readTif(path + baseFileName + band + ".TIF") for band in bands]
-        self.bandData = [fh.read(1) for fh in self.fhs]
-        self.qa = readTif(path + baseFileName + "QA_PIXEL.TIF")
-        self.qaData = self.qa.read(1)
+    def __init__(self, bands, scenePath=DEFAULT_SCENE, useBandCache=False, maxCachedBlocks=64) -> None:
+        """
+            bands:           band names, e.g. `BANDS`
+            scenePath:       path + file-name-prefix of the scene, e.g. "data/ls8/LC09_..._T1_"
+            useBandCache:    memory-map the bands from an uncompressed cache (see `tifReadCached`)
+                             instead of reading them block by block
+            maxCachedBlocks: blocks kept in memory per band (see `TifBlockReader`)
+
+            Nothing is read up front; pixels are fetched on demand through `getPoints` and `getWindow`.
+        """
+        self.fhs = [readTif(scenePath + band + ".TIF") for band in bands]
+        self.qa = readTif(scenePath + "QA_PIXEL.TIF")
+        if useBandCache:
+            self.bands = [_MappedBand(tifReadCached(fh.name)) for fh in self.fhs]
+            self.qaBand = _MappedBand(tifReadCached(self.qa.name))
+        else:
+            self.bands = [TifBlockReader(fh, maxCachedBlocks=maxCachedBlocks) for fh in self.fhs]
+            self.qaBand = TifBlockReader(self.qa, maxCachedBlocks=maxCachedBlocks)
 
 
     def getRandomData(self, bbox):
         row, col = self.__getRandomCoordsWithData(bbox)
-        xs = []
-        for band in self.bandData:
-            x = band[row, col]
-            xs.append(x)
+        xs = list(self.getPoints([row], [col])[0])
         shape = tifGetPixelOutline(self.qa, row, col)
         return xs, shape
 
+    def getClearSkyPixels(self, bbox):
+        """
+            rows and cols of all clear-sky pixels inside `bbox`
+        """
+        window = tifGetBboxWindow(self.qa, bbox)
+        rows, cols = np.nonzero(self.getQa(window) == CLEAR_SKY)
+        return rows + int(window.row_off), cols + int(window.col_off)
+
+    def getPoints(self, rows, cols):
+        """
+            nrPixels * nrBands array of the pixels at (rows[i], cols[i])
+        """
+        return np.stack([band.getPoints(rows, cols) for band in self.bands], axis=-1)
+
+    def getWindow(self, window):
+        """
+            nrBands * h * w array of the pixels inside `window`
+        """
+        return np.stack([band.getWindow(window) for band in self.bands], axis=0)
+
+    def getQa(self, window=None):
+        """
+            QA_PIXEL values inside `window` (default: whole scene)
+        """
+        if window is None:
+            window = rio.windows.Window(0, 0, self.qa.width, self.qa.height)
+        return self.qaBand.getWindow(window)
+
     def __getRandomCoordsWithData(self, bbox):
         hasData = False
         while not hasData:
             lon = bbox["lonMin"] + np.random.random() * (bbox["lonMax"] - bbox["lonMin"])
             lat = bbox["latMin"] + np.random.random() * (bbox["latMax"] - bbox["latMin"])
             row, col = tifLonLatToPixel(self.qa, lon, lat)
-            qaData = self.qaData[row, col]
-            if qaData == 21824:
+            qaData = self.qaBand.getPoints([row], [col])[0]
+            if qaData == CLEAR_SKY:
                 hasData = True
         return row, col
 
     
 
 
-def loadData(nrSamples):
-    yRaw = loadGeoJson("data/ber/BERPublicSearch/features.geojson")
-    lonMin, latMin, lonMax, latMax = box(*yRaw.bounds).buffer(-0.06).bounds  # insetting a little so that we don't hit that many no-data values
-    bbox = {"lonMin": lonMin, "latMin": latMin, "lonMax": lonMax, "latMax": latMax}
+def getBerBbox(berLayer):
+    lonMin, latMin, lonMax, latMax = box(*berLayer.bounds).buffer(-0.06).bounds  # insetting a little so that we don't hit that many no-data values
+    return {"lonMin": lonMin, "latMin": latMin, "lonMax": lonMax, "latMax": latMax}
+
+
+def sampleBulk(ls8, berIndex, bbox, nrSamples, seed=None, stratify=False, batchSize=10000, offset=0, part=None, maxCandidates=None):
+    """
+        Draws `nrSamples` labelled pixels in bulk:
+        candidates are drawn without replacement from the clear-sky pixels inside `bbox`,
+        labelled batch-wise with `getClasses`, and band values are gathered only for the kept pixels.
+
+        seed:     for reproducible draws
+        stratify: aim for equally many samples per (rounded) BER class;
+                  classes that run out of pixels are topped up with samples from the other classes.
+        offset:   skip the first `offset` candidates of the (seeded) draw order, e.g. those consumed
+                  by an earlier call with the same seed; continues a run without repeating pixels.
+        part:     (i, n): only draw from every n-th clear-sky pixel, starting at the i-th,
+                  so that n parallel samplers never draw the same pixel
+        maxCandidates: label at most this many candidates (default: 20 * nrSamples). Without a cap,
+                  a class that is absent from the bbox would have every clear-sky pixel labelled
+                  in search of its quota; with it, what was found is returned, short of `nrSamples` if need be.
+
+        returns: dict with X, Y, rows, cols, shapes and featureIds,
+                 plus nrDrawn:    the nr of candidates examined,
+                 and  nrConsumed: the nr of candidates up to and including the last one kept; continuing at
+                                  offset + nrConsumed re-examines the candidates examined after that one.
+                                  Candidates before it that were passed over for being over quota are skipped for good.
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = ls8.getClearSkyPixels(bbox)
+    if part is not None:
+        i, n = part
+        rows, cols = rows[i::n], cols[i::n]
+    order = rng.permutation(len(rows))
+    quota = int(np.ceil(nrSamples / len(BER_CLASSES)))
+    if maxCandidates is None:
+        maxCandidates = 20 * nrSamples
+    end = min(len(order), offset + maxCandidates)
+
+    validRows, validCols, validY, validShapes, validFeatureIds = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)], [np.zeros(0, dtype=object)], []
+    validPositions = [np.zeros(0, dtype=int)]
+    classCounts = np.zeros(len(BER_CLASSES), dtype=int)
+    nrDrawn = 0
+    for start in range(offset, end, batchSize):
+        idx = order[start:min(start + batchSize, end)]
+        nrDrawn += len(idx)
+        shapes = tifGetPixelOutlinesAt(ls8.qa, rows[idx], cols[idx])
+        y, featureIds = getClasses(berIndex, shapes)
+        valid = y != -9999
+        validRows.append(rows[idx][valid])
+        validCols.append(cols[idx][valid])
+        validY.append(y[valid])
+        validShapes.append(shapes[valid])
+        validPositions.append(np.arange(start, start + len(idx))[valid])
+        validFeatureIds += [f for f, v in zip(featureIds, valid) if v]
+
+        classCounts += np.bincount(np.clip(np.round(y[valid]).astype(int) - 1, 0, len(BER_CLASSES) - 1), minlength=len(BER_CLASSES))
+        if stratify and np.all(classCounts >= quota):
+            break
+        if not stratify and classCounts.sum() >= nrSamples:
+            break
+
+    validRows, validCols, validY, validShapes, validPositions = [np.concatenate(v) for v in [validRows, validCols, validY, validShapes, validPositions]]
+
+    if stratify:
+        classes = np.round(validY).astype(int)
+        rankInClass = np.zeros(len(validY), dtype=int)
+        for c in BER_CLASSES:
+            inClass = classes == c
+            rankInClass[inClass] = np.arange(inClass.sum())
+        underQuota = rankInClass < quota
+        selected = np.concatenate([np.nonzero(underQuota)[0], np.nonzero(~underQuota)[0]])[:nrSamples]
+    else:
+        selected = np.arange(min(nrSamples, len(validY)))
+
+    if len(selected) < nrSamples:
+        print(f"Only found {len(selected)} of {nrSamples} samples with data among {nrDrawn} candidates")
+        nrConsumed = nrDrawn  # everything with data was kept
+    else:
+        nrConsumed = int(validPositions[selected].max()) + 1 - offset
+        if stratify and np.any(classCounts < quota):
+            print(f"Classes {BER_CLASSES[classCounts < quota]} below their quota of {quota} after {nrDrawn} candidates; topped up with other classes")
+
+    return {
+        "X": ls8.getPoints(validRows[selected], validCols[selected]),
+        "Y": validY[selected],
+        "rows": validRows[selected],
+        "cols": validCols[selected],
+        "shapes": validShapes[selected],
+        "featureIds": [validFeatureIds[i] for i in selected],
+        "nrDrawn": nrDrawn,
+        "nrConsumed": nrConsumed,
+    }
 
-    bands = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10", "B11"]
-    ls8 = Ls8(bands)
 
-    X = np.zeros((nrSamples, len(bands)))
+def sampleToStore(store, nrSamples, seed=0, stratify=False, batchSize=10000, scenePath=DEFAULT_SCENE, useBandCache=False):
+    """
+        Fills `store` (a `DatasetStore`) up to `nrSamples` samples, one chunk per batch.
+        The seed and the cursor into the seeded draw-order are kept in the store's manifest,
+        so re-running after a crash continues where the store left off without drawing a pixel twice.
+        The cursor only moves past the last candidate a batch kept (see `nrConsumed` in `sampleBulk`), so the
+        candidates examined after it are examined again by the next batch. With `stratify`, those passed over for
+        being over a batch's quota before the last kept one are not: they are never drawn again.
+    """
+    sampling = store.manifest["sampling"] or {"seed": seed, "scenePath": scenePath, "offset": 0}
+    if sampling["seed"] != seed or sampling["scenePath"] != scenePath:
+        raise Exception(f"Store {store.path} was sampled from {sampling['scenePath']} with seed {sampling['seed']}")
+
+    berIndex = BerIndex("data/ber/BERPublicSearch/features.geojson")
+    bbox = getBerBbox(berIndex)
+    ls8 = Ls8(BANDS, scenePath, useBandCache=useBandCache)
+    sceneId = os.path.basename(scenePath).rstrip("_")
+
+    while store.nrSamples < nrSamples:
+        print(f"... {100 * store.nrSamples / nrSamples}%")
+        samples = sampleBulk(ls8, berIndex, bbox, min(batchSize, nrSamples - store.nrSamples), seed, stratify, batchSize, sampling["offset"])
+        if samples["nrConsumed"] == 0:
+            print(f"No more pixels with data; stopping at {store.nrSamples} samples")
+            break
+        sampling["offset"] += samples["nrConsumed"]
+        if len(samples["Y"]) > 0:
+            store.append(samples, sceneId, seed, sampling)
+
+    return store
+
+
+_sampler = {}
+
+def _initSampler(scenePath, bbox):
+    # memory-mapped bands: all workers share one copy in the os page-cache
+    _sampler["ls8"] = Ls8(BANDS, scenePath, useBandCache=True)
+    _sampler["berIndex"] = BerIndex("data/ber/BERPublicSearch/features.geojson")
+    _sampler["bbox"] = bbox
+
+
+def _sampleInWorker(nrSamples, seed, part, stratify):
+    samples = sampleBulk(_sampler["ls8"], _sampler["berIndex"], _sampler["bbox"], nrSamples, seed, stratify, part=part)
+    return samples["X"], samples["Y"]
+
+
+def loadDataBulk(nrSamples, seed=None, stratify=False, useBandCache=False, nrWorkers=1, scenePath=DEFAULT_SCENE):
+    """
+        Vectorized counterpart to `loadData`, see `sampleBulk`.
+
+        nrWorkers > 1 spreads the sampling over a process-pool:
+        each worker draws its share from its own partition of the clear-sky pixels (see `part` in `sampleBulk`),
+        with its own rng-stream spawned from `seed`, on bands memory-mapped through `tifReadCached`.
+        Results are concatenated in worker order, so a given (seed, nrWorkers) always yields the same samples.
+    """
+    if nrWorkers <= 1:
+        berIndex = BerIndex("data/ber/BERPublicSearch/features.geojson")
+        bbox = getBerBbox(berIndex)
+        ls8 = Ls8(BANDS, scenePath, useBandCache=useBandCache)
+        samples = sampleBulk(ls8, berIndex, bbox, nrSamples, seed, stratify)
+        return samples["X"], samples["Y"]
+
+    with loadGeoJson("data/ber/BERPublicSearch/features.geojson") as fh:
+        bbox = getBerBbox(fh)
+    Ls8(BANDS, scenePath, useBandCache=True)  # builds the band-caches once, before the workers map them
+
+    seeds = np.random.SeedSequence(seed).spawn(nrWorkers)
+    quotas = [len(q) for q in np.array_split(np.arange(nrSamples), nrWorkers)]
+    parts = [(i, nrWorkers) for i in range(nrWorkers)]
+    with ProcessPoolExecutor(max_workers=nrWorkers, initializer=_initSampler, initargs=(scenePath, bbox)) as executor:
+        results = list(executor.map(_sampleInWorker, quotas, seeds, parts, [stratify] * nrWorkers))
+
+    X = np.concatenate([x for x, _ in results])
+    Y = np.concatenate([y for _, y in results])
+    return X, Y
+
+
+def loadData(nrSamples, useBandCache=False):
+    yRaw = BerIndex("data/ber/BERPublicSearch/features.geojson")
+    bbox = getBerBbox(yRaw)
+
+    ls8 = Ls8(BANDS, useBandCache=useBandCache)
+
+    X = np.zeros((nrSamples, len(BANDS)))
     Y = np.zeros((nrSamples,))
 
     s = 0
@@ -133,13 +372,34 @@ def loadData(nrSamples):
 
 
 
+def testSampleToStoreResume(storeDir="testStore", nrSamples=300, batchSize=100):
+    """
+        A stratified store filled in one run must equal one filled in two (interrupted after 2/3),
+        reach `nrSamples`, and hold no pixel twice.
+    """
+    from dataReaders.datasetStore import DatasetStore
+    import shutil
+
+    oneRun = sampleToStore(DatasetStore(f"{storeDir}_oneRun"), nrSamples, seed=3, stratify=True, batchSize=batchSize)
+    sampleToStore(DatasetStore(f"{storeDir}_resumed"), nrSamples - batchSize, seed=3, stratify=True, batchSize=batchSize)
+    resumed = sampleToStore(DatasetStore(f"{storeDir}_resumed"), nrSamples, seed=3, stratify=True, batchSize=batchSize)
+
+    a = oneRun.load(("rows", "cols", "Y"), mmap=False)
+    b = resumed.load(("rows", "cols", "Y"), mmap=False)
+    assert oneRun.nrSamples == resumed.nrSamples == nrSamples
+    for name in a:
+        assert np.array_equal(a[name], b[name])
+    assert len(set(zip(a["rows"], a["cols"]))) == nrSamples
+
+    shutil.rmtree(f"{storeDir}_oneRun")
+    shutil.rmtree(f"{storeDir}_resumed")
+
+
 def testLs8():
     yRaw = loadGeoJson("data/ber/BERPublicSearch/features.geojson")
-    lonMin, latMin, lonMax, latMax = box(*yRaw.bounds).buffer(-0.06).bounds  # insetting a little so that we don't hit that many no-data values
-    bbox = {"lonMin": lonMin, "latMin": latMin, "lonMax": lonMax, "latMax": latMax}
+    bbox = getBerBbox(yRaw)
 
-    bands = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10", "B11"]
-    ls8 = Ls8(bands)
+    ls8 = Ls8(BANDS)
 
     x, shp = ls8.getRandomData(bbox)
 
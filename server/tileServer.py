@@ -0,0 +1,260 @@
+#%%
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+import numpy as np
+import rasterio as rio
+import rasterio.warp as riow
+import rasterio.transform as riot
+from rasterio.io import MemoryFile
+from rasterio.errors import NotGeoreferencedWarning
+from shapely.geometry import shape, box
+from shapely import STRtree
+
+
+"""
+    Small local tile-server for the client. Runs fully offline.
+
+    Routes:
+        /lst/{dateTime}/{z}/{x}/{y}.png         -> lst-COG `lst_{dateTime}.tif` rendered as xyz-tile
+        /buildings/{z}/{x}/{y}.geojson          -> buildings intersecting the tile
+
+    Usage (from repo root):
+        python -m server.tileServer ./analysis_physical/results ./analysis_physical/results/buildings_temperature.geojson
+"""
+
+
+TILE_SIZE = 256
+WEB_MERCATOR_SIZE = 2 * math.pi * 6378137
+
+
+# Same ramp as `blueRedScale` in client/src/graph.ts, applied between `-5` and `35` °C (see `getMaxAndMin`)
+blueRedScale = {
+    0.1: [69, 117, 180],
+    0.3: [145, 191, 219],
+    0.4: [224, 243, 248],
+    0.5: [254, 224, 144],
+    0.6: [252, 141, 89],
+    0.9: [215, 48, 39],
+}
+
+
+def tileBounds3857(z, x, y):
+    res = WEB_MERCATOR_SIZE / 2**z
+    xMin = -WEB_MERCATOR_SIZE / 2 + x * res
+    yMax = WEB_MERCATOR_SIZE / 2 - y * res
+    return xMin, yMax - res, xMin + res, yMax
+
+
+def tileBounds4326(z, x, y):
+    n = 2**z
+    lonMin = x / n * 360.0 - 180.0
+    lonMax = (x + 1) / n * 360.0 - 180.0
+    latMax = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    latMin = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lonMin, latMin, lonMax, latMax
+
+
+def applyColorRamp(data, noDataValue, minVal=-5.0, maxVal=35.0, scale=blueRedScale):
+    """
+        data: h * w float array -> h * w * 4 uint8 rgba array.
+        nan and `noDataValue` become transparent.
+    """
+    keys = np.array(sorted(scale.keys()))
+    colors = np.array([scale[k] for k in keys], dtype=np.float64)
+
+    degree = (data - minVal) / (maxVal - minVal)
+    degree = np.nan_to_num(degree, nan=0.0)
+    rgba = np.zeros(data.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(degree, keys, colors[:, channel]).round()
+
+    noDataMask = np.isnan(data)
+    if noDataValue is not None:
+        noDataMask |= (data == noDataValue)
+    rgba[..., 3] = np.where(noDataMask, 0, 255)
+    return rgba
+
+
+def encodePng(rgba):
+    h, w, _ = rgba.shape
+    with MemoryFile() as memfile, warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)  # png-tiles carry no georeference
+        with memfile.open(driver="PNG", width=w, height=h, count=4, dtype="uint8") as dst:
+            dst.write(np.moveaxis(rgba, -1, 0))
+        return memfile.read()
+
+
+class TileCache:
+    """
+        LRU cache of encoded tiles, evicting the least recently used tiles once `maxBytes` is exceeded.
+        Entries are `(etag, body)`.
+    """
+
+    def __init__(self, maxBytes=256 * 1024 * 1024) -> None:
+        self.maxBytes = maxBytes
+        self.nrBytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, body):
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        with self.lock:
+            if key in self.entries:
+                self.nrBytes -= len(self.entries.pop(key)[1])
+            self.entries[key] = (etag, body)
+            self.nrBytes += len(body)
+            while self.nrBytes > self.maxBytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nrBytes -= len(evicted)
+        return etag, body
+
+
+class LstTiles:
+    def __init__(self, lstDir, minVal=-5.0, maxVal=35.0) -> None:
+        self.lstDir = lstDir
+        self.minVal = minVal
+        self.maxVal = maxVal
+
+    def path(self, dateTime):
+        return os.path.join(self.lstDir, f"lst_{dateTime}.tif")
+
+    def version(self, dateTime):
+        # part of the cache-key, so that re-computed lst-files invalidate old tiles
+        return os.path.getmtime(self.path(dateTime))
+
+    def render(self, dateTime, z, x, y):
+        dstTransform = riot.from_bounds(*tileBounds3857(z, x, y), TILE_SIZE, TILE_SIZE)
+        tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+        with rio.open(self.path(dateTime)) as fh:
+            # the warper only reads the source-window that overlaps the tile
+            riow.reproject(
+                source=rio.band(fh, 1),
+                destination=tile,
+                src_nodata=fh.nodata,
+                dst_transform=dstTransform,
+                dst_crs="EPSG:3857",
+                dst_nodata=np.nan,
+                resampling=riow.Resampling.nearest
+            )
+            noDataValue = fh.nodata
+        rgba = applyColorRamp(tile, noDataValue, self.minVal, self.maxVal)
+        return encodePng(rgba)
+
+
+class BuildingTiles:
+    """
+        Keeps the buildings in memory behind a spatial index and serves those intersecting a tile.
+        Below `minZoom` tiles are empty, so that zoomed-out views don't pull in the whole city.
+        Features keep their full geometry (no clipping), so the client can de-duplicate them by id across tiles.
+    """
+
+    def __init__(self, path, minZoom=13) -> None:
+        self.path = path
+        self.minZoom = minZoom
+        with open(path) as fh:
+            self.features = json.load(fh)["features"]
+        for feature in self.features:
+            feature["id"] = feature["properties"].get("id", feature.get("id"))
+        self.index = STRtree([shape(f["geometry"]) for f in self.features])
+
+    def version(self):
+        return os.path.getmtime(self.path)
+
+    def render(self, z, x, y):
+        features = []
+        if z >= self.minZoom:
+            tileBox = box(*tileBounds4326(z, x, y))
+            features = [self.features[i] for i in sorted(self.index.query(tileBox, predicate="intersects"))]
+        collection = {"type": "FeatureCollection", "features": features}
+        return json.dumps(collection).encode("utf-8")
+
+
+def makeHandler(lstTiles, buildingTiles, cache):
+
+    lstRoute = re.compile(r"^/lst/(?P<dateTime>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+    buildingRoute = re.compile(r"^/buildings/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.geojson$")
+
+    class TileHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = unquote(self.path.split("?")[0])
+            try:
+                match = lstRoute.match(path)
+                if match:
+                    dateTime = match["dateTime"]
+                    if "/" in dateTime or not os.path.exists(lstTiles.path(dateTime)):
+                        return self.respond(404, "text/plain", b"Unknown time")
+                    z, x, y = int(match["z"]), int(match["x"]), int(match["y"])
+                    key = ("lst", dateTime, lstTiles.version(dateTime), z, x, y)
+                    return self.respondCached(key, "image/png", lambda: lstTiles.render(dateTime, z, x, y))
+
+                match = buildingRoute.match(path)
+                if match and buildingTiles is not None:
+                    z, x, y = int(match["z"]), int(match["x"]), int(match["y"])
+                    key = ("buildings", buildingTiles.version(), z, x, y)
+                    return self.respondCached(key, "application/geo+json", lambda: buildingTiles.render(z, x, y))
+
+                return self.respond(404, "text/plain", b"Not found")
+
+            except Exception as e:
+                print(e)
+                return self.respond(500, "text/plain", str(e).encode("utf-8"))
+
+        def respondCached(self, key, contentType, render):
+            cached = cache.get(key)
+            if cached is None:
+                cached = cache.put(key, render())
+            etag, body = cached
+            if self.headers.get("If-None-Match") == etag:
+                return self.respond(304, contentType, b"", etag)
+            return self.respond(200, contentType, body, etag)
+
+        def respond(self, status, contentType, body, etag=None):
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Access-Control-Expose-Headers", "ETag")
+            if etag is not None:
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")  # always revalidate, answered with 304 if unchanged
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+def serve(lstDir, buildingsPath=None, host="localhost", port=8000, cacheBytes=256 * 1024 * 1024):
+    lstTiles = LstTiles(lstDir)
+    buildingTiles = BuildingTiles(buildingsPath) if buildingsPath else None
+    cache = TileCache(cacheBytes)
+    server = ThreadingHTTPServer((host, port), makeHandler(lstTiles, buildingTiles, cache))
+    print(f"Serving tiles on http://{host}:{port}")
+    server.serve_forever()
+
+
+
+if __name__ == "__main__":
+    import sys
+    lstDir = sys.argv[1] if len(sys.argv) > 1 else "./analysis_physical/results"
+    buildingsPath = sys.argv[2] if len(sys.argv) > 2 else os.path.join(lstDir, "buildings_temperature.geojson")
+    serve(lstDir, buildingsPath)
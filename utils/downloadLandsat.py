@@ -1,7 +1,14 @@
 from dotenv import dotenv_values
 from landsatxplore.api import API
-from landsatxplore.earthexplorer import EarthExplorer, EarthExplorerError
+from landsatxplore.earthexplorer import EarthExplorer, EarthExplorerError, EE_DOWNLOAD_URL, DATA_PRODUCTS
 import os
+import json
+import time
+import hashlib
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests as req
 
 
 datasets = {
@@ -15,12 +22,236 @@ datasets = {
     "Landsat 9 Collection 2 Level 2":       "landsat_ot_c2_l2"
 }
 
-def downloadLandsat(bbox, startDate, endDate, maxResults, outputDir = "./data", maxClouds = 50, dataset = "landsat_ot_c2_l1"):
+#%% transports
+
+class HttpTransport:
+    """
+        Plain http(s): scene `{entityId}` is served at `{baseUrl}/{entityId}.tar`,
+        with an optional md5-sidecar at `{baseUrl}/{entityId}.tar.md5`.
+        Mostly useful against a local stand-in server or a mirror.
+    """
+
+    def __init__(self, baseUrl, session=None, timeout=(10, 300)) -> None:
+        self.baseUrl = baseUrl.rstrip("/")
+        self.session = session or req.Session()
+        self.timeout = timeout
+
+    def open(self, entityId, startByte=0):
+        headers = {"Range": f"bytes={startByte}-"} if startByte > 0 else {}
+        response = self.session.get(f"{self.baseUrl}/{entityId}.tar", headers=headers, stream=True, timeout=self.timeout)
+        if response.status_code != 416:
+            response.raise_for_status()
+        return response
+
+    def md5(self, entityId):
+        response = self.session.get(f"{self.baseUrl}/{entityId}.tar.md5", timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.text.split()[0].lower()
+
+
+class EarthExplorerTransport:
+    """
+        Downloads through a logged-in `EarthExplorer`'s session,
+        trying the dataset's data-products in turn, like `EarthExplorer.download` does:
+        each is first resolved to the actual file-url, which then takes the range-requests.
+        EarthExplorer publishes no checksums, so scenes are verified by size and tar-structure only.
+    """
+
+    def __init__(self, ee, dataset, timeout=(10, 300)) -> None:
+        self.session = ee.session
+        self.timeout = timeout
+        self.dataProductIds = DATA_PRODUCTS[dataset]
+
+    def _resolve(self, entityId):
+        # EE_DOWNLOAD_URL answers with json, `{"url": ...}` or `{"errorMessage": ...}`, not with the tar itself;
+        # the resolved url is short-lived, so it's looked up again for every (resumed) attempt
+        errors = []
+        for dataProductId in self.dataProductIds:
+            url = EE_DOWNLOAD_URL.format(data_product_id=dataProductId, entity_id=entityId)
+            response = self.session.get(url, allow_redirects=True, timeout=self.timeout)
+            if not response.ok:
+                errors.append(f"{dataProductId}: {response.status_code}")
+                continue
+            answer = response.json()
+            if answer.get("errorMessage"):
+                errors.append(f"{dataProductId}: {answer['errorMessage']}")
+                continue
+            if answer.get("url"):
+                return answer["url"]
+        raise EarthExplorerError(f"No downloadable data-product for {entityId}: {'; '.join(errors)}")
+
+    def open(self, entityId, startByte=0):
+        headers = {"Range": f"bytes={startByte}-"} if startByte > 0 else {}
+        response = self.session.get(self._resolve(entityId), headers=headers, stream=True, allow_redirects=True, timeout=self.timeout)
+        if response.status_code != 416:
+            response.raise_for_status()
+        return response
+
+    def md5(self, entityId):
+        return None
+
+
+#%% manifest
+
+class DownloadManifest:
+    """
+        `{outputDir}/manifest.json`: per scene (by display-id) its entity-id, status
+        ("downloading", "complete" or "failed"), size, md5 and last error.
+        Only scenes marked "complete" have passed verification.
+    """
+
+    def __init__(self, outputDir) -> None:
+        self.path = os.path.join(outputDir, "manifest.json")
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                self.scenes = json.load(fh)
+        else:
+            self.scenes = {}
+
+    def get(self, displayId):
+        with self.lock:
+            return dict(self.scenes.get(displayId, {}))
+
+    def update(self, displayId, **entries):
+        with self.lock:
+            self.scenes.setdefault(displayId, {}).update(entries)
+            tempPath = f"{self.path}.tmp"
+            with open(tempPath, "w") as fh:
+                json.dump(self.scenes, fh, indent=4)
+            os.replace(tempPath, self.path)
+
+    def completePaths(self, outputDir):
+        with self.lock:
+            paths = [os.path.abspath(os.path.join(outputDir, f"{displayId}.tar"))
+                     for displayId, scene in self.scenes.items() if scene.get("status") == "complete"]
+        return [p for p in paths if os.path.exists(p)]
+
+
+#%% download
+
+def _fileMd5(path, chunkSize=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunkSize), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _isCompleteTar(path):
+    # walks all member-headers; a truncated archive fails on the last, partial member
+    try:
+        with tarfile.open(path, "r:") as tar:
+            for member in tar:
+                pass
+        return True
+    except (tarfile.TarError, EOFError):
+        return False
+
+
+def _expectedSize(response, startByte):
+    contentRange = response.headers.get("Content-Range")
+    if contentRange is not None:
+        return int(contentRange.split("/")[-1])
+    return startByte + int(response.headers["Content-Length"])
+
+
+def downloadScene(transport, entityId, displayId, outputDir, manifest, maxRetries=3, backoffSeconds=5.0, chunkSize=1024 * 1024):
+    """
+        Downloads into `{displayId}.tar.part`, resuming from its current size with a range-request,
+        and only renames it to `{displayId}.tar` once size, md5 (if the transport knows it) and tar-structure check out.
+        returns: the path of the verified tar
+    """
+    tarPath = os.path.join(outputDir, f"{displayId}.tar")
+    partPath = f"{tarPath}.part"
+
+    known = manifest.get(displayId)
+    if known.get("status") == "complete" and os.path.exists(tarPath) and os.path.getsize(tarPath) == known.get("size"):
+        print(f"{displayId}: already complete")
+        return tarPath
+    if os.path.exists(tarPath) and not known and _isCompleteTar(tarPath):
+        # downloaded before there was a manifest
+        manifest.update(displayId, entityId=entityId, status="complete", size=os.path.getsize(tarPath), md5=None, error=None)
+        return tarPath
+
+    manifest.update(displayId, entityId=entityId, status="downloading", error=None)
+    for attempt in range(maxRetries + 1):
+        try:
+            startByte = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+            with transport.open(entityId, startByte) as response:
+                if response.status_code == 416:
+                    # nothing left to fetch (or the part-file is too long, which the size-check below catches)
+                    expectedSize = _expectedSize(response, startByte) if "Content-Range" in response.headers else startByte
+                else:
+                    if startByte > 0 and response.status_code != 206:
+                        # the server ignored the range; start over
+                        startByte = 0
+                    expectedSize = _expectedSize(response, startByte)
+                if response.status_code != 416 and startByte < expectedSize:
+                    print(f"{displayId}: downloading from byte {startByte} of {expectedSize}")
+                    with open(partPath, "ab" if startByte > 0 else "wb") as fh:
+                        for chunk in response.iter_content(chunk_size=chunkSize):
+                            fh.write(chunk)
+
+            size = os.path.getsize(partPath)
+            if size != expectedSize:
+                if size > expectedSize:
+                    os.remove(partPath)
+                raise Exception(f"Size mismatch: got {size} bytes, expected {expectedSize}")
+            expectedMd5 = transport.md5(entityId)
+            md5 = _fileMd5(partPath) if expectedMd5 is not None else None
+            if md5 != expectedMd5 or not _isCompleteTar(partPath):
+                # corrupt rather than incomplete: resuming would not help
+                os.remove(partPath)
+                raise Exception(f"Verification failed (md5 {md5}, expected {expectedMd5})")
+
+            os.replace(partPath, tarPath)
+            manifest.update(displayId, status="complete", size=size, md5=md5, error=None)
+            print(f"{displayId}: complete")
+            return tarPath
+
+        except Exception as e:
+            manifest.update(displayId, error=str(e))
+            if attempt < maxRetries:
+                wait = backoffSeconds * 2**attempt
+                print(f"{displayId}: {e}; retrying in {wait:.0f}s")
+                time.sleep(wait)
+            else:
+                print(f"{displayId}: {e}; giving up")
+                manifest.update(displayId, status="failed")
+                return None
+
+
+def downloadScenes(scenes, outputDir, transport, nrWorkers=4, maxRetries=3):
+    """
+        scenes: list of {"entity_id": ..., "display_id": ...}, as returned by `API.search`
+        Downloads at most `nrWorkers` scenes at once; per-scene progress is kept in `{outputDir}/manifest.json`.
+        returns: paths of all verified tars in `outputDir`, including those of earlier runs
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    manifest = DownloadManifest(outputDir)
+    with ThreadPoolExecutor(max_workers=nrWorkers) as executor:
+        futures = [
+            executor.submit(downloadScene, transport, scene["entity_id"], scene["display_id"], outputDir, manifest, maxRetries)
+            for scene in scenes
+        ]
+        for future in futures:
+            future.result()
+    return manifest.completePaths(outputDir)
+
+
+def downloadLandsat(bbox, startDate, endDate, maxResults, outputDir = "./data", maxClouds = 50, dataset = "landsat_ot_c2_l1",
+                    nrWorkers = 4, transport = None):
+    """
+        Searches EarthExplorer and downloads all results (see `downloadScenes`).
+        `transport`: defaults to EarthExplorer itself; pass e.g. an `HttpTransport` to download from elsewhere.
+    """
 
     config = dotenv_values(".env")
 
     api = API(config["username"], config["password"])
-    ee = EarthExplorer(config["username"], config["password"])
 
     lonMin = bbox["lonMin"]
     latMin = bbox["latMin"]
@@ -36,20 +267,19 @@ def downloadLandsat(bbox, startDate, endDate, maxResults, outputDir = "./data",
         max_cloud_cover=maxClouds,
         max_results=maxResults
     )
+    api.logout()
 
-    for scene in scenes:
-        print(f"Trying to download scene {scene['entity_id']}")
-        try:
-            ee.download(scene["entity_id"], output_dir=outputDir)
-        except EarthExplorerError as e:
-            print(e)
+    ee = None
+    if transport is None:
+        ee = EarthExplorer(config["username"], config["password"])
+        transport = EarthExplorerTransport(ee, dataset)
 
-    api.logout()
-    ee.logout()
+    try:
+        tarFilePaths = downloadScenes(scenes, outputDir, transport, nrWorkers)
+    finally:
+        if ee is not None:
+            ee.logout()
 
-    fileNames = os.listdir(outputDir)
-    tarFilePaths = [os.path.abspath(os.path.join(outputDir, fileName)) 
-                    for fileName in fileNames if fileName.endswith(".tar")]
     return tarFilePaths
 
 
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+"""
+    Landsat collection-2 scenes come as one ~1GB tar per scene, with all bands as flat members
+    `{sceneId}_{ending}` (`..._B10.TIF`, `..._QA_PIXEL.TIF`, `..._MTL.json`, ...).
+    The thermal pipeline only needs a few of them; these helpers extract just those,
+    or read them straight out of the archive through GDAL's `/vsitar/`.
+"""
+
+
+# B10 and B11 for level-1 scenes, ST_B10 for level-2 ones
+L1_THERMAL_ENDINGS = ["B10.TIF", "B11.TIF", "QA_PIXEL.TIF", "MTL.json"]
+L2_THERMAL_ENDINGS = ["ST_B10.TIF", "QA_PIXEL.TIF", "MTL.json"]
+THERMAL_ENDINGS = L1_THERMAL_ENDINGS + ["ST_B10.TIF"]
+OPTICAL_ENDINGS = ["B4.TIF", "B5.TIF"]
+
+
+def sceneIdFromTar(tarPath):
+    return os.path.basename(tarPath)[:-len(".tar")]
+
+
+def thermalEndings(sceneId):
+    """
+        The thermal endings a scene of this processing level has: the level is the second part
+        of the product-id, e.g. L1TP in LC08_L1TP_193026_20220803_20220806_02_T1, L2SP for level-2.
+    """
+    return L2_THERMAL_ENDINGS if sceneId.split("_")[1].startswith("L2") else L1_THERMAL_ENDINGS
+
+
+def _wantedEnding(memberName, endings):
+    # product-ids have seven `_`-separated parts (LC08_L1TP_193026_20220803_20220806_02_T1); the rest is the ending.
+    # Comparing whole endings keeps "B10.TIF" from matching level-2's "ST_B10.TIF".
+    parts = os.path.basename(memberName).split("_", 7)
+    if len(parts) == 8 and parts[7] in endings:
+        return parts[7]
+    return None
+
+
+def tarMembers(tarPath, endings=THERMAL_ENDINGS):
+    """
+        returns: ending -> member-name, for the members of `tarPath` that end in one of `endings`.
+        Only member-headers are read; the archive's data is skipped over.
+    """
+    members = {}
+    with tarfile.open(tarPath, "r:") as tar:
+        for member in tar:
+            ending = _wantedEnding(member.name, endings)
+            if ending is not None and member.isfile():
+                members[ending] = member.name
+    return members
+
+
+def extractScene(tarPath, outputDir, endings=None, fileobj=None):
+    """
+        Extracts the members ending in `endings` (default: the scene's `thermalEndings`)
+        to `{outputDir}/{sceneId}/{sceneId}_{ending}`, the layout `getLs8Scenes` expects, in a single pass over the archive.
+        Other members are seeked past, or, when reading from a non-seekable `fileobj`
+        (e.g. a download's raw response), read past; but never written.
+        Scenes that have been extracted before are left alone.
+
+        returns: the scene's directory
+    """
+    sceneId = sceneIdFromTar(tarPath)
+    endings = endings or thermalEndings(sceneId)
+    sceneDir = os.path.join(outputDir, sceneId)
+    targets = {ending: os.path.join(sceneDir, f"{sceneId}_{ending}") for ending in endings}
+    missing = {ending for ending, target in targets.items() if not os.path.exists(target)}
+    if len(missing) == 0:
+        return sceneDir
+
+    os.makedirs(sceneDir, exist_ok=True)
+    tar = tarfile.open(tarPath, "r:") if fileobj is None else tarfile.open(fileobj=fileobj, mode="r|")
+    with tar:
+        for member in tar:
+            ending = _wantedEnding(member.name, missing)
+            if ending is None or not member.isfile():
+                continue
+            # to a temporary file first, so that an interrupted ingest never leaves a truncated band behind
+            tempPath = f"{targets[ending]}.{os.getpid()}.tmp"
+            with tar.extractfile(member) as src, open(tempPath, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tempPath, targets[ending])
+            missing.remove(ending)
+            if len(missing) == 0:
+                break
+
+    if len(missing) > 0:
+        print(f"{sceneId}: not in archive: {sorted(missing)}")
+    return sceneDir
+
+
+def extractScenes(tarPaths, outputDir, endings=None, nrWorkers=None):
+    """
+        `extractScene` for many archives, in a process-pool
+        returns: the scenes' directories
+    """
+    with ProcessPoolExecutor(max_workers=nrWorkers) as executor:
+        futures = [executor.submit(extractScene, tarPath, outputDir, endings) for tarPath in tarPaths]
+        return [future.result() for future in futures]
+
+
+def sceneFromTar(tarPath, fileDict):
+    """
+        Like one entry of `getLs8Scenes`, but pointing into the archive instead of to extracted files:
+        fileDict: key -> ending, e.g. {"b10": "B10.TIF", "meta": "MTL.json"}
+        returns: key -> `/vsitar/`-path, for the members the archive has;
+                 tifs open with `readTif` as usual, json with `readTarMember`
+    """
+    members = tarMembers(tarPath, list(fileDict.values()))
+    absPath = os.path.abspath(tarPath)
+    return {key: f"/vsitar/{absPath}/{members[ending]}" for key, ending in fileDict.items() if ending in members}
+
+
+def readTarMember(vsiPath):
+    """
+        returns: the bytes of a member, given as a `/vsitar/{tarPath}/{memberName}`-path
+    """
+    tarPath, memberName = vsiPath[len("/vsitar/"):].split(".tar/", 1)
+    with tarfile.open(f"{tarPath}.tar", "r:") as tar:
+        with tar.extractfile(memberName) as fh:
+            return fh.read()
+
+
+
+def testExtractSceneTwice():
+    """
+        Extracting an extracted level-1 scene again must not open its archive (here: removed in between)
+    """
+    import io
+    import tempfile
+    sceneId = "LC08_L1TP_193026_20220803_20220806_02_T1"
+    with tempfile.TemporaryDirectory() as tempDir:
+        tarPath = os.path.join(tempDir, f"{sceneId}.tar")
+        with tarfile.open(tarPath, "w") as tar:
+            for ending in L1_THERMAL_ENDINGS + ["B4.TIF"]:
+                member = tarfile.TarInfo(f"{sceneId}_{ending}")
+                member.size = 4
+                tar.addfile(member, io.BytesIO(b"data"))
+
+        sceneDir = extractScene(tarPath, tempDir)
+        assert sorted(os.listdir(sceneDir)) == sorted(f"{sceneId}_{ending}" for ending in L1_THERMAL_ENDINGS)
+        os.remove(tarPath)
+        assert extractScene(tarPath, tempDir) == sceneDir
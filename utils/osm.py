@@ -1,8 +1,21 @@
 import os
 import json
+import time
+import re
+import codecs
+import math
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests as req
 
 
+OVERPASS_URLS = ["http://overpass-api.de/api/interpreter"]
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+
 # Tested with http://overpass-turbo.eu/#
 
 def nodeToPoint(node):
@@ -46,33 +59,30 @@ def nodeToLineString(way):
 
 
 def osmToGeojson(data, format="polygon", saveFreeNodes=False):
-    elements = data["elements"]
-
-    try: 
-        ways =  [e for e in elements if e["type"] == "way"]
-        if format == "polygon":
-            polygons = [nodeToPoly(way) for way in ways]
-            features = polygons
-        elif format == "linestring":
-            lineStrings = [nodeToLineString(way) for way in ways]
-            features = lineStrings
-        else:
-            raise Exception(f"Unknown format: {format}")
+    if format == "polygon":
+        wayToFeature = nodeToPoly
+    elif format == "linestring":
+        wayToFeature = nodeToLineString
+    else:
+        raise Exception(f"Unknown format: {format}")
+
+    # single pass over all elements; free nodes are those no way refers to
+    features = []
+    nodes = []
+    referencedNodeIds = set()
+    try:
+        for e in data["elements"]:
+            if e["type"] == "way":
+                features.append(wayToFeature(e))
+                if saveFreeNodes:
+                    referencedNodeIds.update(e["nodes"])
+            elif e["type"] == "node" and saveFreeNodes:
+                nodes.append(e)
     except Exception as e:
         print(e)
 
     if saveFreeNodes:
-        nodes = [e for e in elements if e["type"] == "node"]
-        freeNodes = []
-        for node in nodes:
-            isFreeNode = True
-            for way in ways:
-                if node["id"] in way["nodes"]:
-                    isFreeNode = False
-                    break
-            if isFreeNode:
-                freeNodes.append(node) 
-        freePoints = [nodeToPoint(n) for n in freeNodes]
+        freePoints = [nodeToPoint(n) for n in nodes if n["id"] not in referencedNodeIds]
         features += freePoints
 
     json = {
@@ -82,9 +92,7 @@ def osmToGeojson(data, format="polygon", saveFreeNodes=False):
     return json
 
 
-def downloadAndSaveOSM(bbox, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True, getRoads=True):
-    overpass_url = "http://overpass-api.de/api/interpreter"
-
+def overpassQueries(bbox):
     lonMin = bbox["lonMin"]
     latMin = bbox["latMin"]
     lonMax = bbox["lonMax"]
@@ -128,58 +136,371 @@ def downloadAndSaveOSM(bbox, saveToDirPath=None, getBuildings=True, getTrees=Tru
         out geom;
     """
 
-    fullData = {}
+    # layer -> (query, geojson-format)
+    return {
+        "buildings": (buildingQuery, "polygon"),
+        "trees":     (treesQuery,    "polygon"),
+        "water":     (waterQuery,    "polygon"),
+        "roads":     (roadQuery,     "linestring"),
+    }
+
+
+def makeSession(poolSize=4):
+    """
+        http-session with a connection-pool large enough for `poolSize` concurrent requests
+    """
+    session = req.Session()
+    adapter = req.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _retryAfterSeconds(response):
+    retryAfter = response.headers.get("Retry-After")
+    if retryAfter is None:
+        return None
+    try:
+        return max(float(retryAfter), 0.0)
+    except ValueError:
+        retryDate = parsedate_to_datetime(retryAfter)
+        return max((retryDate - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def _requestOverpass(session, query, overpassUrls, timeout, maxRetries, backoffSeconds, stream=False):
+    for attempt in range(maxRetries + 1):
+        url = overpassUrls[attempt % len(overpassUrls)]
+        try:
+            response = session.post(url, data={"data": query}, timeout=timeout, stream=stream)
+        except (req.ConnectionError, req.Timeout) as e:
+            error = e
+            wait = backoffSeconds * 2**attempt
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                return response
+            response.close()
+            error = Exception(f"Overpass responded with {response.status_code}")
+            wait = _retryAfterSeconds(response)
+            if wait is None:
+                wait = backoffSeconds * 2**attempt
+
+        if attempt < maxRetries:
+            print(f"{error}; retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+    raise Exception(f"Overpass query failed after {maxRetries + 1} attempts: {error}")
+
+
+def fetchOverpass(session, query, overpassUrls=OVERPASS_URLS, timeout=(10, 300), maxRetries=5, backoffSeconds=2.0):
+    """
+        Sends `query` to the first of `overpassUrls`, rotating through them on retries.
+        Busy (429) and gateway errors (502, 503, 504), as well as connection-errors and time-outs,
+        are retried with exponential backoff; a `Retry-After` header takes precedence over the backoff.
+        returns: the parsed json response
+    """
+    return _requestOverpass(session, query, overpassUrls, timeout, maxRetries, backoffSeconds).json()
+
+
+def iterOverpassElements(chunks):
+    """
+        Incrementally parses an overpass json-response, given as an iterable of byte-chunks,
+        and yields the entries of its "elements"-array one by one.
+        Only the current, partially received element is ever held in memory.
+        Raises once the elements are through if overpass reports a runtime error (see `_runtimeError`):
+        the elements yielded until then are only part of the result.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+
+    def readMore():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        nonlocal buffer, pos
+        buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+        return True
+
+    # skip the header up to the opening bracket of the elements-array
+    while True:
+        start = buffer.find('"elements"')
+        bracket = buffer.find("[", start) if start >= 0 else -1
+        if bracket >= 0:
+            pos = bracket + 1
+            break
+        if not readMore():
+            raise Exception("No elements in overpass-response")
+
+    # elements are parsed in place, by moving `pos` through the buffer rather than slicing it
+    separators = re.compile(r"[\s,]*")
+    while True:
+        pos = separators.match(buffer, pos).end()
+        if buffer.startswith("]", pos):
+            pos += 1
+            break
+        try:
+            element, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if not readMore():
+                raise Exception("Overpass-response ended inside the elements-array")
+            continue
+        yield element
+
+    # overpass reports run-time errors (like time-outs) in a remark *after* the elements
+    tail = buffer[pos:] + "".join(utf8.decode(chunk) for chunk in chunks)
+    remarkStart = tail.find('"remark"')
+    if remarkStart >= 0:
+        remark = tail[remarkStart:].strip().rstrip("}").strip()
+        if "runtime error" in remark:
+            raise Exception(f"Overpass-response is incomplete: {remark}")
+        print(f"Overpass {remark}")
+
+
+def streamOverpassToFile(session, query, filePath, format="polygon", overpassUrls=OVERPASS_URLS, timeout=(10, 300),
+                         maxRetries=5, backoffSeconds=2.0, chunkSize=1024 * 1024):
+    """
+        Streams the response to `query` into `filePath` as line-delimited geojson (one feature per line),
+        converting every way as it arrives (see `nodeToPoly`, `nodeToLineString`).
+        Memory stays flat regardless of the size of the response. Free nodes are not kept.
+        `filePath` is only written once the response turned out complete; a truncated one raises.
+        returns: nr of features written
+    """
+    if format == "polygon":
+        wayToFeature = nodeToPoly
+    elif format == "linestring":
+        wayToFeature = nodeToLineString
+    else:
+        raise Exception(f"Unknown format: {format}")
+
+    nrFeatures = 0
+    tempPath = f"{filePath}.{threading.get_ident()}.tmp"
+    try:
+        with _requestOverpass(session, query, overpassUrls, timeout, maxRetries, backoffSeconds, stream=True) as response, \
+             open(tempPath, "w") as fh:
+            for e in iterOverpassElements(response.iter_content(chunk_size=chunkSize)):
+                if e["type"] == "way":
+                    fh.write(json.dumps(wayToFeature(e)))
+                    fh.write("\n")
+                    nrFeatures += 1
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+    os.replace(tempPath, filePath)
+    return nrFeatures
+
+
+def readFeatureFile(filePath):
+    """
+        Iterates over the features of a line-delimited geojson file as written by `streamOverpassToFile`
+    """
+    with open(filePath) as fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
+def downloadAndSaveOSM(bbox, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True, getRoads=True,
+                       overpassUrls=OVERPASS_URLS, maxConcurrent=4, session=None, timeout=(10, 300), maxRetries=5):
+    """
+        Fetches the requested layers concurrently (at most `maxConcurrent` requests at a time) over one pooled session.
+        `overpassUrls` and `session` can point to a local stand-in server, e.g. for tests.
+        Note that the public overpass-instance allows only a few parallel requests per ip;
+        excess ones are answered with 429 and retried (see `fetchOverpass`).
+    """
+    wanted = {"buildings": getBuildings, "trees": getTrees, "water": getWater, "roads": getRoads}
+    queries = {layer: q for layer, q in overpassQueries(bbox).items() if wanted[layer]}
+    session = session or makeSession(maxConcurrent)
 
     if saveToDirPath is not None:
         os.makedirs(saveToDirPath, exist_ok=True)
 
-    if getBuildings:
-        response = req.get(overpass_url, params={'data': buildingQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["buildings"] = geojson
+    def fetchLayer(layer):
+        query, format = queries[layer]
+        data = fetchOverpass(session, query, overpassUrls, timeout, maxRetries)
+        geojson = osmToGeojson(data, format)
 
         if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, 'buildings.geo.json')
+            filePath = os.path.join(saveToDirPath, f'{layer}.geo.json')
             with open(filePath, 'w') as fh:
                 json.dump(geojson, fh, indent=4)
 
-    if getTrees:
-        response = req.get(overpass_url, params={'data': treesQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["trees"] = geojson
+        return geojson
 
-        if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, 'trees.geo.json')
-            with open(filePath, 'w') as fh:
-                json.dump(geojson, fh, indent=4)
+    with ThreadPoolExecutor(max_workers=maxConcurrent) as executor:
+        futures = {layer: executor.submit(fetchLayer, layer) for layer in queries}
+        fullData = {layer: future.result() for layer, future in futures.items()}
 
-    if getWater:
-        response = req.get(overpass_url, params={'data': waterQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["water"] = geojson
+    return fullData
 
-        if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, 'water.geo.json')
-            with open(filePath, 'w') as fh:
-                json.dump(geojson, fh, indent=4)
 
-    if getRoads:
-        response = req.get(overpass_url, params={'data': roadQuery})
-        data = response.json()
-        geojson = osmToGeojson(data, "linestring")
-        fullData["roads"] = geojson
+def _tileGrid(bbox, tileSizeDeg):
+    # tiles are aligned to a global grid, so that overlapping AOIs share tiles (and cache-entries)
+    colMin = math.floor(bbox["lonMin"] / tileSizeDeg)
+    colMax = math.ceil(bbox["lonMax"] / tileSizeDeg)
+    rowMin = math.floor(bbox["latMin"] / tileSizeDeg)
+    rowMax = math.ceil(bbox["latMax"] / tileSizeDeg)
+    for row in range(rowMin, rowMax):
+        for col in range(colMin, colMax):
+            tileBbox = {
+                "lonMin": round(col * tileSizeDeg, 10),
+                "latMin": round(row * tileSizeDeg, 10),
+                "lonMax": round((col + 1) * tileSizeDeg, 10),
+                "latMax": round((row + 1) * tileSizeDeg, 10),
+            }
+            yield (row, col), tileBbox
+
+
+def _splitTile(tileBbox):
+    lonMid = (tileBbox["lonMin"] + tileBbox["lonMax"]) / 2
+    latMid = (tileBbox["latMin"] + tileBbox["latMax"]) / 2
+    for lonMin, lonMax in [(tileBbox["lonMin"], lonMid), (lonMid, tileBbox["lonMax"])]:
+        for latMin, latMax in [(tileBbox["latMin"], latMid), (latMid, tileBbox["latMax"])]:
+            yield {"lonMin": lonMin, "latMin": latMin, "lonMax": lonMax, "latMax": latMax}
+
+
+def _runtimeError(data):
+    # overpass answers a query that timed out or ran out of memory with 200 and whatever elements it had by then;
+    # only the "runtime error"-remark tells such a truncated response from a complete one
+    remark = data.get("remark", "")
+    return remark if "runtime error" in remark else None
+
 
+def _datedQuery(query, date):
+    # `date` (yyyy-mm-dd) pins the query to the map's state on that day
+    return query.replace("[out:json];", f'[out:json][date:"{date}T00:00:00Z"];', 1)
+
+
+def downloadAndSaveOSMTiled(bbox, cacheDir, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True, getRoads=True,
+                            tileSizeDeg=0.05, date=None, maxAgeDays=None, maxSplits=3, overpassUrls=OVERPASS_URLS,
+                            maxConcurrent=4, session=None, timeout=(10, 300), maxRetries=5):
+    """
+        Like `downloadAndSaveOSM`, but splits `bbox` into a grid of `tileSizeDeg`-sized tiles,
+        so that no single query has to cover a whole metro-area.
+
+        Every tile's raw response is cached under `cacheDir`, keyed by layer, date, tile and a hash of the query;
+        re-running an overlapping AOI only fetches the tiles that are not cached yet.
+        `date`:       yyyy-mm-dd; if given, the map's state on that day is queried (and cached for good),
+                      otherwise the current map, cached as "latest".
+        `maxAgeDays`: re-fetch "latest"-tiles cached longer ago than this; None keeps them indefinitely.
+        `maxSplits`:  a tile whose query overpass aborts with a runtime error (time-out, out of memory)
+                      is split into quarters and those are queried instead, down to `maxSplits` times;
+                      beyond that, the download fails. Truncated responses never enter the cache.
+
+        Ways crossing tile-borders are returned by every tile they touch; they are merged by their OSM id.
+        Features come from whole tiles, so they may reach a little beyond `bbox`.
+    """
+    wanted = {"buildings": getBuildings, "trees": getTrees, "water": getWater, "roads": getRoads}
+    dateKey = date or "latest"
+    session = session or makeSession(maxConcurrent)
+
+    jobs = []
+    def tileQuery(layer, tileBbox):
+        query = overpassQueries(tileBbox)[layer][0]
+        return query if date is None else _datedQuery(query, date)
+
+    for tile, tileBbox in _tileGrid(bbox, tileSizeDeg):
+        for layer in overpassQueries(tileBbox):
+            if not wanted[layer]:
+                continue
+            queryHash = hashlib.sha1(tileQuery(layer, tileBbox).encode("utf-8")).hexdigest()[:12]
+            cachePath = os.path.join(cacheDir, layer, dateKey, f"{tile[0]}_{tile[1]}_{queryHash}.json")
+            jobs.append((layer, tileBbox, cachePath))
+
+    def isCached(cachePath):
+        if not os.path.exists(cachePath):
+            return False
+        if date is None and maxAgeDays is not None:
+            return time.time() - os.path.getmtime(cachePath) <= maxAgeDays * 24 * 3600
+        return True
+
+    def fetchSplitting(layer, tileBbox, splitsLeft):
+        data = fetchOverpass(session, tileQuery(layer, tileBbox), overpassUrls, timeout, maxRetries)
+        error = _runtimeError(data)
+        if error is None:
+            return data
+        if splitsLeft == 0:
+            raise Exception(f"Overpass {error} (tile {tileBbox}, split {maxSplits} times already)")
+        print(f"Overpass {error}; splitting tile {tileBbox}")
+        elements = {}
+        for subBbox in _splitTile(tileBbox):
+            for e in fetchSplitting(layer, subBbox, splitsLeft - 1)["elements"]:
+                elements[(e["type"], e["id"])] = e
+        return {"elements": list(elements.values())}
+
+    def fetchTile(job):
+        layer, tileBbox, cachePath = job
+        if isCached(cachePath):
+            return False
+        data = fetchSplitting(layer, tileBbox, maxSplits)
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        tempPath = f"{cachePath}.{threading.get_ident()}.tmp"
+        with open(tempPath, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tempPath, cachePath)
+        return True
+
+    with ThreadPoolExecutor(max_workers=maxConcurrent) as executor:
+        fetched = list(executor.map(fetchTile, jobs))
+    print(f"Fetched {sum(fetched)} of {len(jobs)} tile-queries, {len(jobs) - sum(fetched)} from cache")
+
+    if saveToDirPath is not None:
+        os.makedirs(saveToDirPath, exist_ok=True)
+
+    fullData = {}
+    for layer, (_, format) in overpassQueries(bbox).items():
+        if not wanted[layer]:
+            continue
+
+        # merge the raw elements, de-duplicated by (type, id)
+        elements = {}
+        for jobLayer, _, cachePath in jobs:
+            if jobLayer != layer:
+                continue
+            with open(cachePath) as fh:
+                for e in json.load(fh)["elements"]:
+                    elements[(e["type"], e["id"])] = e
+
+        geojson = osmToGeojson({"elements": list(elements.values())}, format)
         if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, 'roads.geo.json')
+            filePath = os.path.join(saveToDirPath, f'{layer}.geo.json')
             with open(filePath, 'w') as fh:
                 json.dump(geojson, fh, indent=4)
+        fullData[layer] = geojson
 
     return fullData
 
 
+def downloadAndStreamOSM(bbox, saveToDirPath, getBuildings=True, getTrees=True, getWater=True, getRoads=True,
+                         overpassUrls=OVERPASS_URLS, maxConcurrent=4, session=None, timeout=(10, 300), maxRetries=5):
+    """
+        Like `downloadAndSaveOSM`, but streams every layer straight into `{saveToDirPath}/{layer}.geojsonl`
+        (see `streamOverpassToFile`) instead of building the feature-collections in memory.
+        returns: layer -> file-path
+    """
+    wanted = {"buildings": getBuildings, "trees": getTrees, "water": getWater, "roads": getRoads}
+    queries = {layer: q for layer, q in overpassQueries(bbox).items() if wanted[layer]}
+    session = session or makeSession(maxConcurrent)
+    os.makedirs(saveToDirPath, exist_ok=True)
+
+    def streamLayer(layer):
+        query, format = queries[layer]
+        filePath = os.path.join(saveToDirPath, f'{layer}.geojsonl')
+        nrFeatures = streamOverpassToFile(session, query, filePath, format, overpassUrls, timeout, maxRetries)
+        print(f"{layer}: {nrFeatures} features")
+        return filePath
+
+    with ThreadPoolExecutor(max_workers=maxConcurrent) as executor:
+        futures = {layer: executor.submit(streamLayer, layer) for layer in queries}
+        filePaths = {layer: future.result() for layer, future in futures.items()}
+
+    return filePaths
+
+
 # osmData = downloadAndSaveOSM(osmDir, bbox)
 
 
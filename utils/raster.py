@@ -1,4 +1,8 @@
 #%%
+import os
+import json
+from functools import lru_cache
+from collections import OrderedDict
 import rasterio as rio
 import rasterio.features as riof
 import rasterio.transform as riot
@@ -6,6 +10,7 @@ import rasterio.shutil as rios
 from pyproj.transformer import Transformer
 from utils.vectorAndRaster import _rasterize_geom
 from shapely.geometry import shape, box
+import shapely
 import numpy as np
 
 #%%
@@ -54,6 +59,104 @@ def readTif(targetFilePath):
     return fh
 
 
+def tifReadCached(targetFilePath, band=1, cacheDir=None):
+    """
+        Like `readTif(path).read(band)`, but decompresses the band only once:
+        the pixels are kept in an uncompressed `.npy` file next to the source (or in `cacheDir`)
+        and later reads memory-map that file (read-only, zero-copy).
+        Processes reading the same band thereby share the os page-cache instead of each holding a copy.
+        The cache is rebuilt when the source's size or mtime change.
+    """
+    baseName = os.path.basename(targetFilePath) if cacheDir else targetFilePath
+    cachePath = os.path.join(cacheDir or "", baseName) + f".band{band}.npy"
+    metaPath = cachePath + ".json"
+
+    stat = os.stat(targetFilePath)
+    sourceInfo = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    if os.path.exists(cachePath) and os.path.exists(metaPath):
+        with open(metaPath) as fh:
+            if json.load(fh) == sourceInfo:
+                return np.load(cachePath, mmap_mode="r")
+
+    # decompress block by block into a temp-file, so that concurrent builders never see a half-written cache
+    tempPath = f"{cachePath}.{os.getpid()}.tmp"
+    with rio.open(targetFilePath, "r") as fh:
+        data = np.lib.format.open_memmap(tempPath, mode="w+", dtype=fh.dtypes[band - 1], shape=(fh.height, fh.width))
+        for _, window in fh.block_windows(band):
+            data[window.toslices()] = fh.read(band, window=window)
+        data.flush()
+        del data
+    os.replace(tempPath, cachePath)
+    with open(metaPath + f".{os.getpid()}.tmp", "w") as fh:
+        json.dump(sourceInfo, fh)
+    os.replace(metaPath + f".{os.getpid()}.tmp", metaPath)
+
+    return np.load(cachePath, mmap_mode="r")
+
+
+class TifBlockReader:
+    """
+        On-demand access to one band of an open tif, read block by block (the file's own internal blocks).
+        The `maxCachedBlocks` most recently used blocks are kept in memory,
+        so memory follows the pixels actually touched instead of the size of the scene.
+    """
+
+    def __init__(self, fh, band=1, maxCachedBlocks=64) -> None:
+        self.fh = fh
+        self.band = band
+        self.maxCachedBlocks = maxCachedBlocks
+        self.blockH, self.blockW = fh.block_shapes[band - 1]
+        self.nrBlockCols = (fh.width + self.blockW - 1) // self.blockW
+        self.dtype = fh.dtypes[band - 1]
+        self.blocks = OrderedDict()
+
+    def getBlock(self, blockRow, blockCol):
+        key = (blockRow, blockCol)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        r0, c0 = blockRow * self.blockH, blockCol * self.blockW
+        window = rio.windows.Window(c0, r0, min(self.blockW, self.fh.width - c0), min(self.blockH, self.fh.height - r0))
+        block = self.fh.read(self.band, window=window)
+        self.blocks[key] = block
+        if len(self.blocks) > self.maxCachedBlocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def getPoints(self, rows, cols):
+        """
+            pixel values at (rows[i], cols[i]); each touched block is read once
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        values = np.empty(len(rows), dtype=self.dtype)
+        blockIds = (rows // self.blockH) * self.nrBlockCols + (cols // self.blockW)
+        order = np.argsort(blockIds, kind="stable")
+        groups = np.split(order, np.flatnonzero(np.diff(blockIds[order])) + 1)
+        for group in groups:
+            if len(group) == 0:
+                continue
+            blockRow, blockCol = divmod(int(blockIds[group[0]]), self.nrBlockCols)
+            block = self.getBlock(blockRow, blockCol)
+            values[group] = block[rows[group] - blockRow * self.blockH, cols[group] - blockCol * self.blockW]
+        return values
+
+    def getWindow(self, window):
+        """
+            pixel values inside `window`, assembled from the overlapping blocks
+        """
+        (r0, r1), (c0, c1) = [(int(start), int(stop)) for start, stop in window.toranges()]
+        values = np.empty((r1 - r0, c1 - c0), dtype=self.dtype)
+        for blockRow in range(r0 // self.blockH, (r1 - 1) // self.blockH + 1):
+            for blockCol in range(c0 // self.blockW, (c1 - 1) // self.blockW + 1):
+                block = self.getBlock(blockRow, blockCol)
+                br0, bc0 = blockRow * self.blockH, blockCol * self.blockW
+                rs, re = max(r0, br0), min(r1, br0 + block.shape[0])
+                cs, ce = max(c0, bc0), min(c1, bc0 + block.shape[1])
+                values[rs - r0:re - r0, cs - c0:ce - c0] = block[rs - br0:re - br0, cs - bc0:ce - bc0]
+        return values
+
+
 def saveToTif(targetFilePath: str, data: np.ndarray, crs: str, transform, noDataVal, extraProps=None):
     h, w = data.shape
     options = {
@@ -168,6 +271,35 @@ def tifGetBboxRough(fh, bbox):
     return pixels, outline
 
 
+def tifGetBboxWindow(fh, bbox):
+    """
+        Pixel-window of `fh` covering `bbox` (EPSG:4326), clipped to the raster
+    """
+    coordTransformer = Transformer.from_crs("EPSG:4326", fh.crs, always_xy=True)
+    bounds = coordTransformer.transform_bounds(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])
+    window = fh.window(*bounds).round_offsets().round_lengths()
+    fullWindow = rio.windows.Window(0, 0, fh.width, fh.height)
+    return window.intersection(fullWindow)
+
+
+def tifGetBbox(fh, bbox):
+    """
+        All bands' pixels of `fh` inside `bbox` (EPSG:4326), as bands * rows * cols
+    """
+    return fh.read(window=tifGetBboxWindow(fh, bbox))
+
+
+def tifClipToCOG(sourcePath, bbox, targetPath):
+    """
+        Saves the part of `sourcePath` covering `bbox` as a COG, in the source's own crs and pixel-grid,
+        so that `tifGetBbox` on the clip returns the same pixels as on the source.
+    """
+    with readTif(sourcePath) as fh:
+        window = tifGetBboxWindow(fh, bbox)
+        data = fh.read(1, window=window)
+        saveToCOG(targetPath, data, fh.crs, fh.window_transform(window), fh.nodata, "copy", fh.tags())
+
+
 def tifGetPixels(fh, r0, r1, c0, c1, channels=None):
     # adding one so that end-index is also included
     window = rio.windows.Window.from_slices(( r0,  r1+1 ), ( c0,  c1+1 ))
@@ -207,5 +339,69 @@ def tifGetPixelOutline(fh, row, col):
     return outline
 
 
+def _cornersToOutlines(xs, ys):
+    """
+        xs, ys: (h+1) * (w+1) arrays of pixel-corner coordinates
+        returns: h * w array of shapely polygons
+    """
+    h, w = xs.shape[0] - 1, xs.shape[1] - 1
+    ring = [
+        (xs[:-1, :-1], ys[:-1, :-1]),
+        (xs[:-1, 1:],  ys[:-1, 1:] ),
+        (xs[1:, 1:],   ys[1:, 1:]  ),
+        (xs[1:, :-1],  ys[1:, :-1] ),
+        (xs[:-1, :-1], ys[:-1, :-1]),
+    ]
+    coords = np.stack([np.stack(corner, axis=-1) for corner in ring], axis=-2)
+    outlines = shapely.polygons(coords.reshape(h * w, 5, 2))
+    return outlines.reshape(h, w)
+
+
+def tifGetPixelOutlinesAt(fh, rows, cols, crs="EPSG:4326"):
+    """
+        Footprints of the pixels at (rows[i], cols[i]) as an array of shapely polygons, in `crs`.
+        Point-wise counterpart to `tifGetPixelOutlines`, for scattered pixels.
+    """
+    rows = np.asarray(rows)[:, np.newaxis]
+    cols = np.asarray(cols)[:, np.newaxis]
+    cornerRows = rows + np.array([0, 0, 1, 1, 0])
+    cornerCols = cols + np.array([0, 1, 1, 0, 0])
+    xs, ys = fh.transform * (cornerCols, cornerRows)
+    if crs is not None and crs != fh.crs:
+        coordTransformer = Transformer.from_crs(fh.crs, crs, always_xy=True)
+        xs, ys = coordTransformer.transform(xs, ys)
+    return shapely.polygons(np.stack([xs, ys], axis=-1))
+
+
+@lru_cache(maxsize=32)
+def _tifGetPixelOutlines(name, transform, tifCrs, r0, c0, h, w, crs):
+    rows, cols = np.mgrid[r0:r0 + h + 1, c0:c0 + w + 1]
+    xs, ys = transform * (cols, rows)
+    if crs is not None and crs != tifCrs:
+        coordTransformer = Transformer.from_crs(tifCrs, crs, always_xy=True)
+        xs, ys = coordTransformer.transform(xs, ys)
+    outlines = _cornersToOutlines(np.asarray(xs), np.asarray(ys))
+    outlines.flags.writeable = False
+    return outlines
+
+
+def tifGetPixelOutlines(fh, window, crs="EPSG:4326", cache=True):
+    """
+        Footprints of all pixels in `window` as an h * w array of shapely polygons,
+        in `crs` (pass `None` for the tif's own crs).
+        All corners are transformed in one bulk call; results are cached per (dataset, window, crs),
+        so the returned array is read-only. Pass `cache=False` for one-off windows, e.g. when walking a whole scene.
+        Unlike `tifGetPixelOutline` the corners are transformed exactly instead of approximated by half-pixel shifts.
+    """
+    if not isinstance(window, rio.windows.Window):
+        window = rio.windows.Window.from_slices(*window)
+    getOutlines = _tifGetPixelOutlines if cache else _tifGetPixelOutlines.__wrapped__
+    return getOutlines(
+        fh.name, fh.transform, fh.crs.to_string(),
+        int(window.row_off), int(window.col_off), int(window.height), int(window.width),
+        crs
+    )
+
+
 
 # %%
@@ -0,0 +1,253 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from pyproj.transformer import Transformer
+from shapely.geometry import Polygon, box
+from utils.raster import readTif, tifClipToCOG
+from utils.landsatTar import readTarMember
+
+
+# QA_PIXEL-value of clear-sky land, see `extractClouds`
+CLEAR_SKY = 21824
+
+
+def _readMetaBytes(path):
+    if path.startswith("/vsitar/"):
+        return readTarMember(path)
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+def _readMeta(path):
+    return json.loads(_readMetaBytes(path))
+
+
+def _footprint(meta):
+    # the corners of the product's extent, as listed in the MTL
+    projection = meta["LANDSAT_METADATA_FILE"]["PROJECTION_ATTRIBUTES"]
+    corners = [
+        (float(projection[f"CORNER_{corner}_LON_PRODUCT"]), float(projection[f"CORNER_{corner}_LAT_PRODUCT"]))
+        for corner in ["UL", "UR", "LR", "LL"]
+    ]
+    return Polygon(corners)
+
+
+def aoiClearFraction(qaPath, bbox, decimation=1, clearValue=CLEAR_SKY):
+    """
+        Fraction of the pixels in `bbox` that are clear sky; pixels of `bbox` outside the scene count as not clear.
+        decimation: only every n-th row and column is read (from an overview, where the file has one);
+                    nearest-neighbour, so QA-values stay intact. With 8, that's 1/64th of the reads,
+                    for a fraction within about a percent of the full read (on a 128 * 128 pixel aoi).
+    """
+    with readTif(qaPath) as fh:
+        coordTransformer = Transformer.from_crs("EPSG:4326", fh.crs, always_xy=True)
+        bounds = coordTransformer.transform_bounds(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])
+        window = fh.window(*bounds).round_offsets().round_lengths()
+        nrPixels = window.width * window.height
+        try:
+            window = window.intersection(rio.windows.Window(0, 0, fh.width, fh.height))
+        except rio.errors.WindowError:
+            return 0.0
+        outShape = (max(-(-window.height // decimation), 1), max(-(-window.width // decimation), 1))
+        qa = fh.read(1, window=window, out_shape=outShape, resampling=Resampling.nearest)
+    coveredFraction = window.width * window.height / max(nrPixels, 1)
+    return float(np.mean(qa == clearValue)) * coveredFraction
+
+
+class SceneCatalog:
+    """
+        SQLite-catalog of local scenes, filled at ingest, so that scene-selection never has to open a scene.
+            - scenes:       scene-id, acquisition date-time (as `getDateTime`), footprint, overall clear-sky fraction
+                            (from the MTL's CLOUD_COVER) and the band-files (as in `getLs8Scenes`)
+            - sceneBounds:  R*Tree over the footprints' bboxes
+            - aois:         registered areas of interest
+            - aoiClear:     clear-sky fraction per (scene, aoi), for every scene that overlaps the aoi
+            - aoiClips:     per (scene, aoi) the files of the scene clipped to the aoi, if `clipDir` is given
+
+        Registering an aoi computes its clear-sky fraction for the scenes already in the catalog;
+        ingesting a scene computes it for the aois already registered. Each costs one (decimated) QA-window read.
+
+        With `clipDir`, every (scene, aoi)-pair's tifs are also clipped to the aoi once, as small COGs in
+        `{clipDir}/{aoiName}/{sceneId}/{sceneId}_{ending}` (the layout of `getLs8Scenes`), with the MTL copied alongside.
+        `query` then returns those instead of the full scenes, which can go to cold storage afterwards.
+
+        With `maxSceneCloudCover` [%], scenes whose MTL-CLOUD_COVER is above it are catalogued, but neither read
+        nor clipped: their scene-wide clear-sky fraction stands in for the aois'.
+    """
+
+    def __init__(self, path, clipDir=None, qaDecimation=1, maxSceneCloudCover=None) -> None:
+        self.clipDir = clipDir
+        self.qaDecimation = qaDecimation
+        self.maxSceneCloudCover = maxSceneCloudCover
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS scenes (
+                id              INTEGER PRIMARY KEY,
+                sceneId         TEXT UNIQUE NOT NULL,
+                dateTime        TEXT NOT NULL,
+                footprint       TEXT NOT NULL,
+                clearFraction   REAL,
+                files           TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS scenesDateTime ON scenes (dateTime);
+            CREATE VIRTUAL TABLE IF NOT EXISTS sceneBounds USING rtree (id, lonMin, lonMax, latMin, latMax);
+            CREATE TABLE IF NOT EXISTS aois (
+                id              INTEGER PRIMARY KEY,
+                name            TEXT UNIQUE NOT NULL,
+                lonMin REAL, latMin REAL, lonMax REAL, latMax REAL
+            );
+            CREATE TABLE IF NOT EXISTS aoiClear (
+                sceneRowId      INTEGER NOT NULL REFERENCES scenes (id),
+                aoiId           INTEGER NOT NULL REFERENCES aois (id),
+                clearFraction   REAL NOT NULL,
+                PRIMARY KEY (aoiId, sceneRowId)
+            );
+            CREATE TABLE IF NOT EXISTS aoiClips (
+                sceneRowId      INTEGER NOT NULL REFERENCES scenes (id),
+                aoiId           INTEGER NOT NULL REFERENCES aois (id),
+                files           TEXT NOT NULL,
+                PRIMARY KEY (aoiId, sceneRowId)
+            );
+        """)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def _intersecting(self, bbox):
+        # bbox-candidates from the R*Tree, then the exact footprint-test
+        rows = self.db.execute("""
+            SELECT scenes.id, scenes.sceneId, scenes.footprint, scenes.clearFraction, scenes.files FROM sceneBounds JOIN scenes ON scenes.id = sceneBounds.id
+            WHERE sceneBounds.lonMin <= ? AND sceneBounds.lonMax >= ? AND sceneBounds.latMin <= ? AND sceneBounds.latMax >= ?
+        """, (bbox["lonMax"], bbox["lonMin"], bbox["latMax"], bbox["latMin"])).fetchall()
+        aoiBox = box(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])
+        return [row for row in rows if Polygon(json.loads(row["footprint"])).intersects(aoiBox)]
+
+
+    def _clip(self, sceneId, files, aoi):
+        sceneDir = os.path.join(self.clipDir, aoi["name"], sceneId)
+        os.makedirs(sceneDir, exist_ok=True)
+        clipped = {}
+        for key, path in files.items():
+            # band-files are named `{sceneId}_{ending}`, in the archive as well as extracted
+            target = os.path.join(sceneDir, os.path.basename(path))
+            if key == "meta":
+                with open(target, "wb") as fh:
+                    fh.write(_readMetaBytes(path))
+            elif path.upper().endswith(".TIF"):
+                tifClipToCOG(path, dict(aoi), target)
+            else:
+                continue
+            clipped[key] = target
+        return clipped
+
+
+    def _addSceneToAoi(self, rowId, sceneId, files, aoi, sceneClearFraction):
+        if self.maxSceneCloudCover is not None and sceneClearFraction < 1.0 - self.maxSceneCloudCover / 100.0:
+            # clouded over as a whole: not worth a QA-read, let alone a clip
+            self.db.execute("INSERT INTO aoiClear VALUES (?, ?, ?)", (rowId, aoi["id"], sceneClearFraction))
+            return
+        self.db.execute("INSERT INTO aoiClear VALUES (?, ?, ?)", (rowId, aoi["id"], aoiClearFraction(files["qa"], dict(aoi), self.qaDecimation)))
+        if self.clipDir is not None:
+            self.db.execute("INSERT INTO aoiClips VALUES (?, ?, ?)", (rowId, aoi["id"], json.dumps(self._clip(sceneId, files, aoi))))
+
+
+    def hasScene(self, sceneId):
+        return self.db.execute("SELECT 1 FROM scenes WHERE sceneId = ?", (sceneId,)).fetchone() is not None
+
+
+    def ingestScene(self, files):
+        """
+            files: key -> path of one scene, as returned by `getLs8Scenes`; must contain "meta" (MTL.json) and "qa" (QA_PIXEL).
+            Scenes already in the catalog are skipped.
+            returns: the scene-id
+        """
+        sceneId = os.path.basename(files["meta"])[:-len("_MTL.json")]
+        if self.hasScene(sceneId):
+            return sceneId
+
+        meta = _readMeta(files["meta"])
+        attributes = meta["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]
+        dateTime = f"{attributes['DATE_ACQUIRED']} {attributes['SCENE_CENTER_TIME']}"
+        clearFraction = 1.0 - float(attributes["CLOUD_COVER"]) / 100.0
+        footprint = _footprint(meta)
+        lonMin, latMin, lonMax, latMax = footprint.bounds
+
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO scenes (sceneId, dateTime, footprint, clearFraction, files) VALUES (?, ?, ?, ?, ?)",
+                (sceneId, dateTime, json.dumps(list(footprint.exterior.coords)), clearFraction, json.dumps(files))
+            )
+            rowId = cursor.lastrowid
+            self.db.execute("INSERT INTO sceneBounds VALUES (?, ?, ?, ?, ?)", (rowId, lonMin, lonMax, latMin, latMax))
+
+            for aoi in self.db.execute("SELECT * FROM aois").fetchall():
+                aoiBox = box(aoi["lonMin"], aoi["latMin"], aoi["lonMax"], aoi["latMax"])
+                if footprint.intersects(aoiBox):
+                    self._addSceneToAoi(rowId, sceneId, files, aoi, clearFraction)
+
+        return sceneId
+
+
+    def registerAoi(self, name, bbox):
+        """
+            Adds an aoi (or replaces the bbox of an existing one) and computes its clear-sky fraction in every overlapping scene
+        """
+        with self.db:
+            existing = self.db.execute("SELECT * FROM aois WHERE name = ?", (name,)).fetchone()
+            unchanged = existing is not None and all(existing[key] == bbox[key] for key in ["lonMin", "latMin", "lonMax", "latMax"])
+            if existing is not None:
+                self.db.execute("UPDATE aois SET lonMin = ?, latMin = ?, lonMax = ?, latMax = ? WHERE id = ?",
+                                (bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"], existing["id"]))
+                aoiId = existing["id"]
+                if not unchanged:
+                    self.db.execute("DELETE FROM aoiClear WHERE aoiId = ?", (aoiId,))
+                    self.db.execute("DELETE FROM aoiClips WHERE aoiId = ?", (aoiId,))
+            else:
+                aoiId = self.db.execute("INSERT INTO aois (name, lonMin, latMin, lonMax, latMax) VALUES (?, ?, ?, ?, ?)",
+                                        (name, bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])).lastrowid
+
+            aoi = self.db.execute("SELECT * FROM aois WHERE id = ?", (aoiId,)).fetchone()
+            known = {row[0] for row in self.db.execute("SELECT sceneRowId FROM aoiClear WHERE aoiId = ?", (aoiId,))}
+            for scene in self._intersecting(bbox):
+                if scene["id"] not in known:
+                    self._addSceneToAoi(scene["id"], scene["sceneId"], json.loads(scene["files"]), aoi, scene["clearFraction"])
+        return aoiId
+
+
+    def query(self, aoiName, startDate=None, endDate=None, minClearFraction=0.0):
+        """
+            Scenes overlapping the registered aoi `aoiName`, acquired in [startDate, endDate] (yyyy-mm-dd, both optional),
+            with at least `minClearFraction` of the aoi clear of clouds, in order of acquisition.
+            returns: list of file-dicts as from `getLs8Scenes` (pointing to the clipped files, where there are any),
+                     plus "sceneId", "dateTime" and "clearFraction"
+        """
+        sql = """
+            SELECT scenes.sceneId, scenes.dateTime, COALESCE(aoiClips.files, scenes.files) AS files, aoiClear.clearFraction
+            FROM aois JOIN aoiClear ON aoiClear.aoiId = aois.id JOIN scenes ON scenes.id = aoiClear.sceneRowId
+            LEFT JOIN aoiClips ON aoiClips.aoiId = aoiClear.aoiId AND aoiClips.sceneRowId = aoiClear.sceneRowId
+            WHERE aois.name = ? AND aoiClear.clearFraction >= ?
+        """
+        params = [aoiName, minClearFraction]
+        if startDate is not None:
+            sql += " AND scenes.dateTime >= ?"
+            params.append(startDate)
+        if endDate is not None:
+            # date-times start with the date, so anything on `endDate` sorts below `endDate` + "~"
+            sql += " AND scenes.dateTime <= ?"
+            params.append(f"{endDate}~")
+        sql += " ORDER BY scenes.dateTime"
+
+        scenes = []
+        for row in self.db.execute(sql, params):
+            scene = json.loads(row["files"])
+            scene["sceneId"] = row["sceneId"]
+            scene["dateTime"] = row["dateTime"]
+            scene["clearFraction"] = row["clearFraction"]
+            scenes.append(scene)
+        return scenes
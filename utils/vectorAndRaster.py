@@ -1,7 +1,9 @@
 import numpy as np
 import rasterio.transform as riot
 import rasterio.features as riof
-from shapely.geometry import shape, box
+from shapely.geometry import shape
+import shapely
+from utils.geometryStore import GeometryStore
 
 
 
@@ -47,15 +49,23 @@ def createAffine(bbox, rasterShape):
 
 
 def rasterizeGeojson(geojson, bbox, imgShape):
+    """
+        geojson: a feature-collection or a `GeometryStore`
+    """
+
+    if isinstance(geojson, GeometryStore):
+        shapes = [(g, 1) for g in geojson.geometries(geojson.queryBbox(bbox))]
+    else:
+        shapes = [(f["geometry"], 1) for f in geojson["features"]]
 
-    if len(geojson["features"]) == 0:
+    if len(shapes) == 0:
         return np.zeros(imgShape)
 
     imgH, imgW = imgShape
     transform = createAffine(bbox, imgShape)
    
     rasterized = riof.rasterize(
-        [(f["geometry"], 1) for f in geojson["features"]], 
+        shapes, 
         (imgH, imgW),
         all_touched=True,
         transform=transform
@@ -79,6 +89,13 @@ def _rasterize_geom(geometry, shape, affinetrans, all_touched):
     return rv_array
 
 
+def _cell_boxes(rows, cols, atrans):
+    # Cell bounds as in rasterio DatasetReader.window_bounds, for all (row, col) at once
+    x_min, y_min = atrans * (cols, rows + 1)
+    x_max, y_max = atrans * (cols + 1, rows)
+    return shapely.box(x_min, y_min, x_max, y_max)
+
+
 def _rasterize_pctcover(geom, atrans, shape):
     alltouched = _rasterize_geom(geom, shape, atrans, all_touched=True)
     exterior = _rasterize_geom(geom.exterior, shape, atrans, all_touched=True)
@@ -88,25 +105,16 @@ def _rasterize_pctcover(geom, atrans, shape):
     # we'll update this array for exterior points
     pctcover = (alltouched - exterior) * 100
 
-    # loop through indicies of all exterior cells
-    for r, c in zip(*np.where(exterior == 1)):
-
-        # Find cell bounds, from rasterio DatasetReader.window_bounds
-        window = ((r, r+1), (c, c+1))
-        ((row_min, row_max), (col_min, col_max)) = window
-        x_min, y_min = (col_min, row_max) * atrans
-        x_max, y_max = (col_max, row_min) * atrans
-        bounds = (x_min, y_min, x_max, y_max)
+    # all exterior cells at once
+    rows, cols = np.where(exterior == 1)
+    cells = _cell_boxes(rows, cols, atrans)
 
-        # Construct shapely geometry of cell
-        cell = box(*bounds)
+    # Intersect with original shape
+    cell_overlap = shapely.intersection(cells, geom)
 
-        # Intersect with original shape
-        cell_overlap = cell.intersection(geom)
-
-        # update pctcover with percentage based on area proportion
-        coverage = cell_overlap.area / cell.area
-        pctcover[r, c] = int(coverage * 100)
+    # update pctcover with percentage based on area proportion
+    coverage = shapely.area(cell_overlap) / shapely.area(cells)
+    pctcover[rows, cols] = (coverage * 100).astype(int)
 
     return pctcover
 
@@ -132,33 +140,32 @@ def _multi_rasterize_pctcover(shapes, atrans, shape):
     # we'll update this array for exterior points
     pctcover = (alltouched - exterior) * 100
 
-    # loop through indicies of all exterior cells
-    for r, c in zip(*np.where(exterior == 1)):
-
-        # Find cell bounds, from rasterio DatasetReader.window_bounds
-        window = ((r, r+1), (c, c+1))
-        ((row_min, row_max), (col_min, col_max)) = window
-        x_min, y_min = (col_min, row_max) * atrans
-        x_max, y_max = (col_max, row_min) * atrans
-        bounds = (x_min, y_min, x_max, y_max)
-
-        # Construct shapely geometry of cell
-        cell = box(*bounds)
+    # all exterior cells at once
+    rows, cols = np.where(exterior == 1)
+    cells = _cell_boxes(rows, cols, atrans)
 
-        # Intersect with original shape
-        cell_overlap_area = 0 
-        for geom in shapes:
-            cell_overlap_area += cell.intersection(geom).area
+    # Intersect with original shapes: only cell/shape-pairs that the spatial index reports as intersecting
+    tree = shapely.STRtree(shapes)
+    cellIdx, shapeIdx = tree.query(cells, predicate="intersects")
+    overlapAreas = shapely.area(shapely.intersection(cells[cellIdx], tree.geometries[shapeIdx]))
+    cell_overlap_area = np.bincount(cellIdx, weights=overlapAreas, minlength=len(cells))
 
-        # update pctcover with percentage based on area proportion
-        coverage = cell_overlap_area / cell.area
-        pctcover[r, c] = int(coverage * 100)
+    # update pctcover with percentage based on area proportion
+    coverage = cell_overlap_area / shapely.area(cells)
+    pctcover[rows, cols] = (coverage * 100).astype(int)
 
     return pctcover
 
 
 def rasterizePercentage(geometries, bbox, imageSize):
+    """
+        geometries: list of geojson-geometries or a `GeometryStore`
+    """
     atrans = createAffine(bbox, imageSize)
-    shapes = [shape(g) for g in geometries]
+    if isinstance(geometries, GeometryStore):
+        # mixed layers are stored as multipolygons; the coverage is computed per polygon
+        shapes = list(shapely.get_parts(geometries.geometries(geometries.queryBbox(bbox))))
+    else:
+        shapes = [shape(g) for g in geometries]
     pctCover = _multi_rasterize_pctcover(shapes, atrans, imageSize)
     return pctCover
\ No newline at end of file